@@ -0,0 +1,221 @@
+""" Throughput benchmarks for environ
+
+Runs without an anvil server by pointing environ at an in-memory table that can add latency to
+every call, standing in for the round trip to app_tables.  Each scenario reports ops/sec, table
+round trips per call and p50/p99 latency as JSON so results can be compared between commits.
+
+    python benchmarks/bench_environ.py --sizes 10 1000 --environments 2 50 --latency 0.001
+    python benchmarks/bench_environ.py --output bench_output.txt
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+from typing import Callable, Iterable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server_code"))
+
+import anvil.secrets  # noqa: E402
+
+from environ import backends, models, src  # noqa: E402
+
+
+# The environment the benchmark runs as, it resolves to the 'Debug' column by prefix
+ENVIRONMENT_NAME = "Debug for bench@example.com"
+
+
+class LatencyBackend(backends.Backend):
+    """ Wrap a backend to add latency to every call and count the round trips """
+    def __init__(self, base: backends.Backend, latency: float = 0.0):
+        super().__init__(base.name)
+        self.base = base
+        self.latency = latency
+        self.calls = 0
+
+    def _round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def exists(self) -> bool:
+        self._round_trip()
+        return self.base.exists()
+
+    def list_columns(self) -> list[dict]:
+        self._round_trip()
+        return self.base.list_columns()
+
+    def get(self, **search):
+        self._round_trip()
+        return self.base.get(**search)
+
+    def search(self, keys: Iterable[str] | None = None, any_of: list[dict] | None = None) -> list:
+        self._round_trip()
+        return self.base.search(keys, any_of)
+
+    def add_rows(self, rows: list[dict]) -> list:
+        self._round_trip()
+        return self.base.add_rows(rows)
+
+    def update(self, row, values: dict):
+        self._round_trip()
+        return self.base.update(row, values)
+
+    def upsert(self, search: dict, values: dict):
+        if type(self.base).upsert is not backends.Backend.upsert:
+            # The backend has its own upsert, a single round trip
+            self._round_trip()
+            return self.base.upsert(search, values)
+        # The generic upsert goes through get, add_rows and update above
+        return super().upsert(search, values)
+
+    def transaction(self):
+        return self.base.transaction()
+
+
+class FakeSecrets:
+    """ Stand in for anvil.secrets.get_secret with the same latency as the table """
+    def __init__(self, backend: LatencyBackend):
+        self.backend = backend
+
+    def get_secret(self, name: str) -> str:
+        self.backend._round_trip()
+        return f"value of {name}"
+
+
+def environment_columns(count: int) -> list[str]:
+    """'Published', 'Debug' and per-developer debug columns to make up the count"""
+    columns = ["Published", "Debug"]
+    columns += [f"Debug for user{i}@example.com" for i in range(count - len(columns))]
+    return columns[:count]
+
+
+def build_table(size: int, environments: list[str]) -> backends.MemoryBackend:
+    """Every key has a default row, half also have a row for the Debug environment"""
+    rows = list()
+    for i in range(size):
+        rows.append({"key": f"key_{i}", "value": i})
+        if i % 2 == 0:
+            rows.append({"key": f"key_{i}", "value": -i, "Debug": True})
+    rows.append({"key": "secret", "value": models.Secret("bench_secret")})
+    return backends.MemoryBackend("env", environments=environments, rows=rows)
+
+
+def measure(operation: Callable[[int], object], iterations: int, backend: LatencyBackend) -> dict:
+    """Time each call to the operation and summarize"""
+    operation(0)
+    backend.calls = 0
+    durations = list()
+    for i in range(iterations):
+        start = time.perf_counter()
+        operation(i)
+        durations.append(time.perf_counter() - start)
+
+    durations.sort()
+    total = sum(durations)
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / total if total else None,
+        "round_trips_per_call": backend.calls / iterations,
+        "mean_us": statistics.fmean(durations) * 1e6,
+        "p50_us": durations[len(durations) // 2] * 1e6,
+        "p99_us": durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1e6,
+    }
+
+
+def scenarios(size: int, environments: list[str]) -> dict[str, Callable[[int], object]]:
+    """Operations to benchmark against a table of the given size"""
+    environment_set = set(environments)
+    variables = models.Variables()
+
+    def key(i):
+        return f"key_{random.randrange(size)}"
+
+    def register(i):
+        variable = models.Variable(f"registered_{i % size}", i)
+        variable.value = i
+        variables._register(variable)
+        return len(variables.in_use), len(variables.available)
+
+    return {
+        "get_hit": lambda i: src.get(f"key_{2 * random.randrange((size + 1) // 2)}"),
+        "get_default_row": lambda i: src.get(f"key_{2 * random.randrange(size // 2) + 1}" if size > 1 else "key_0"),
+        "get_code_default": lambda i: src.get(f"missing_{i % size}", None),
+        "get_secret": lambda i: src.get("secret"),
+        "get_many_10": lambda i: src.get_many([key(i) for _ in range(10)]),
+        "set": lambda i: src.set(key(i), i),
+        "resolve_environment": lambda i: src.resolve_environment(ENVIRONMENT_NAME, environment_set),
+        "resolver": lambda i: src.DB.resolver.resolve(ENVIRONMENT_NAME),
+        "variables": register,
+    }
+
+
+def run(sizes: list[int], environment_counts: list[int], latency: float, iterations: int, snapshot: list[bool]) -> dict:
+    src.ENVIRONMENT._environment = SimpleNamespace(name=ENVIRONMENT_NAME, tags=[])
+    get_secret = anvil.secrets.get_secret
+
+    results = list()
+    try:
+        for size in sizes:
+            for environment_count in environment_counts:
+                environments = environment_columns(environment_count)
+                for use_snapshot in snapshot:
+                    backend = LatencyBackend(build_table(size, environments), latency)
+                    anvil.secrets.get_secret = FakeSecrets(backend).get_secret
+                    src.DB = models.EnvDB("env", backend=backend, snapshot=use_snapshot)
+                    src.VARIABLES = models.Variables()
+                    for name, operation in scenarios(size, environments).items():
+                        result = measure(operation, iterations, backend)
+                        result.update(
+                            scenario=name,
+                            size=size,
+                            environments=environment_count,
+                            snapshot=use_snapshot,
+                            latency_s=latency,
+                        )
+                        results.append(result)
+                        print(
+                            f"{name:>20} size={size:<6} environments={environment_count:<3} snapshot={use_snapshot!s:<5} "
+                            f"{result['ops_per_sec']:>12,.0f} ops/s {result['round_trips_per_call']:>5.2f} trips/call "
+                            f"p50={result['p50_us']:,.1f}us p99={result['p99_us']:,.1f}us",
+                            file=sys.stderr,
+                        )
+    finally:
+        anvil.secrets.get_secret = get_secret
+
+    return {
+        "python": platform.python_version(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000], help="keys in the table")
+    parser.add_argument("--environments", type=int, nargs="+", default=[2, 10, 50], help="environment columns")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every round trip")
+    parser.add_argument("--iterations", type=int, default=200, help="calls per scenario")
+    parser.add_argument("--snapshot", choices=["on", "off", "both"], default="both", help="EnvDB snapshot mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here rather than stdout")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    snapshot = {"on": [True], "off": [False], "both": [False, True]}[args.snapshot]
+    report = run(args.sizes, args.environments, args.latency, args.iterations, snapshot)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
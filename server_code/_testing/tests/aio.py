@@ -0,0 +1,56 @@
+from anvil_testing import helpers
+
+from ... import environ
+
+from .conftest import _SlowBackend, _memory_backend, _mock
+
+import asyncio
+
+
+class TestAget:
+    def test_get(self):
+        _mock.use_backend(_memory_backend(_SlowBackend))
+        _mock.debug()
+        assert asyncio.run(environ.aget("url")) == "debug.example.com"
+        assert asyncio.run(environ.aget("missing", "CodeDefault")) == "CodeDefault"
+        with helpers.raises(LookupError):
+            asyncio.run(environ.aget("missing"))
+        _mock.enable_environments()
+
+    def test_concurrent_awaits(self):
+        _mock.use_backend(_memory_backend(_SlowBackend))
+        _mock.published()
+        environ.get("url")
+
+        async def burst():
+            return await asyncio.gather(*[environ.aget("url") for _ in range(10)], environ.aget("missing", None))
+
+        with environ.count_queries() as queries:
+            results = asyncio.run(burst())
+        assert results == ["example.com"] * 10 + [None]
+        assert queries["search"] == 2, f"Concurrent awaits for a variable should share one search {queries}"
+        _mock.enable_environments()
+
+
+class TestAgetMany:
+    def test_get_many(self):
+        _mock.use_backend(_memory_backend(_SlowBackend))
+        _mock.published()
+        values = asyncio.run(environ.aget_many(["url", "port", "missing"], defaults={"missing": None}))
+        assert values == {"url": "example.com", "port": 8080, "missing": None}
+        with helpers.raises(LookupError):
+            asyncio.run(environ.aget_many(["url", "missing"]))
+        _mock.enable_environments()
+
+
+class TestAset:
+    def test_set(self):
+        _mock.use_backend(_memory_backend(_SlowBackend), snapshot=True)
+        _mock.published()
+
+        async def set_and_get():
+            await environ.aset("url", "set.example.com")
+            return await environ.aget("url")
+
+        assert asyncio.run(set_and_get()) == "set.example.com"
+        _mock.enable_environments()
@@ -0,0 +1,121 @@
+from anvil import tables
+
+from anvil_testing import helpers
+
+from ... import environ
+from ...environ import backends
+
+from .conftest import _mock
+
+
+def _check_semantics(backend):
+    """Run the same get/set/environment matching checks against any backend"""
+    _mock.use_backend(backend)
+
+    environ.set("url", "default.example.com")
+    environ.set("url", "debug.example.com", environments={"Debug": True})
+    environ.set("url", "example.com", environments=["Published"])
+    environ.set("flags", {"beta": [1, 2]})
+
+    _mock.debug("abc")
+    assert environ.get("url") == "debug.example.com"
+    _mock.published()
+    assert environ.get("url") == "example.com"
+    _mock.staging()
+    assert environ.get("url") == "default.example.com"
+    assert environ.get("flags") == {"beta": [1, 2]}
+    assert environ.get("missing", 1) == 1
+
+    environ.set_many({"url": "new.example.com", "port": 8080})
+    assert environ.get_many(["url", "port"]) == {"url": "new.example.com", "port": 8080}
+
+    backend.add_rows([{"key": "overlap", "value": 1, "Debug": True}, {"key": "overlap", "value": 2, "Debug": True}])
+    _mock.debug("abc")
+    with helpers.raises(tables.TableError):
+        environ.get("overlap")
+
+
+class TestMemoryBackend:
+    def test_semantics(self):
+        _check_semantics(backends.MemoryBackend(environments=["Debug", "Published"]))
+        _mock.enable_environments()
+
+    def test_columns(self):
+        backend = backends.MemoryBackend(environments=["Debug"])
+        columns = {column["name"]: column["type"] for column in backend.list_columns()}
+        assert columns == {"key": "string", "value": "simpleObject", "info": "string", "Debug": "bool"}
+
+    def test_search(self):
+        backend = backends.MemoryBackend(
+            environments=["Debug"],
+            rows=[{"key": "a", "value": 1}, {"key": "a", "value": 2, "Debug": True}, {"key": "b", "value": 3}],
+        )
+        assert len(backend.search()) == 3
+        assert len(backend.search(keys=["a"])) == 2
+        assert [row["value"] for row in backend.search(any_of=[{"key": "a", "Debug": True}])] == [2]
+
+
+class TestSQLiteBackend:
+    def test_semantics(self):
+        _check_semantics(backends.SQLiteBackend(environments=["Debug", "Published"]))
+        _mock.enable_environments()
+
+    def test_columns(self):
+        backend = backends.SQLiteBackend(environments=["Debug for abc@example.com"])
+        columns = {column["name"]: column["type"] for column in backend.list_columns()}
+        assert columns == {
+            "key": "string", "value": "simpleObject", "info": "string", "Debug for abc@example.com": "bool"
+        }
+
+    def test_rollback(self):
+        backend = backends.SQLiteBackend()
+        with helpers.raises(ValueError):
+            with backend.transaction():
+                backend.add_rows([{"key": "a", "value": 1}])
+                raise ValueError("roll back")
+        assert backend.search() == []
+
+
+class TestEnvironBackend:
+    def test_overlay(self):
+        base = backends.MemoryBackend(
+            environments=["Debug"],
+            rows=[{"key": "port", "value": 1, "Debug": True}, {"key": "host", "value": "localhost"}],
+        )
+        backend = backends.EnvironBackend(base, environ={"port": "8080", "name": "worker"})
+        _mock.use_backend(backend)
+        _mock.debug()
+        assert environ.get("port") == 8080, "os.environ should override every environment"
+        assert environ.get("host") == "localhost"
+        assert environ.get("name") == "worker"
+        assert {row["key"] for row in backend.search()} == {"port", "host"}, (
+            "Without a prefix only keys in the base table are listed"
+        )
+        assert environ.get_many(["port", "host"]) == {"port": 8080, "host": "localhost"}
+        _mock.enable_environments()
+
+    def test_prefix(self):
+        backend = backends.EnvironBackend(prefix="ENV_", environ={"ENV_name": "worker", "PATH": "/bin"})
+        _mock.use_backend(backend, snapshot=True)
+        assert environ.get("name") == "worker"
+        assert environ.get("PATH", None) is None
+        assert {row["key"] for row in backend.search()} == {"name"}
+        _mock.enable_environments()
+
+    def test_columns_looked_up_once(self):
+        base = backends.MemoryBackend(environments=["Debug"])
+        calls = []
+        list_columns = base.list_columns
+        base.list_columns = lambda: calls.append(1) or list_columns()
+        backend = backends.EnvironBackend(base, environ={"port": "8080", "name": "worker"})
+        rows = backend.search(keys=["port", "name"])
+        assert all(row["Debug"] is None for row in rows)
+        assert backend.get(key="port")["value"] == 8080
+        assert len(calls) == 1, f"The base columns should be looked up once, not per row {calls}"
+
+    def test_read_only(self):
+        backend = backends.EnvironBackend(environ={})
+        _mock.use_backend(backend)
+        with helpers.raises(NotImplementedError):
+            environ.set("name", "worker")
+        _mock.enable_environments()
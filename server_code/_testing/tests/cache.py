@@ -0,0 +1,345 @@
+from anvil import tables
+
+from anvil_testing import helpers
+
+from ...environ import backends, cache
+
+import threading
+import time
+import zlib
+
+
+ENVIRONMENTS = {"Debug", "Published"}
+
+
+def _row(key, value, **environments):
+    row = {"key": key, "value": value}
+    row.update({env: environments.get(env) for env in ENVIRONMENTS})
+    return row
+
+
+class TestSnapshot:
+    def test_environment_lookup(self):
+        rows = [
+            _row("a", "default"),
+            _row("a", "debug", Debug=True),
+            _row("a", "published", Published=True),
+        ]
+        snapshot = cache.Snapshot(rows, ENVIRONMENTS)
+        assert snapshot.get(key="a", Debug=True)["value"] == "debug"
+        assert snapshot.get(key="a", Published=True)["value"] == "published"
+        assert snapshot.get(key="a", Debug=None, Published=None)["value"] == "default"
+        assert snapshot.get(key="b", Debug=True) is None
+
+    def test_all_false_is_not_default(self):
+        snapshot = cache.Snapshot([_row("a", 1, Debug=False, Published=False)], ENVIRONMENTS)
+        assert snapshot.get(key="a", Debug=None, Published=None) is None
+        assert snapshot.get(key="a", Debug=False)["value"] == 1
+
+    def test_no_environments(self):
+        snapshot = cache.Snapshot([{"key": "a", "value": 1}], set())
+        assert snapshot.get(key="a")["value"] == 1
+
+    def test_overlap(self):
+        rows = [
+            _row("a", 1, Debug=True, Published=True),
+            _row("a", 2, Debug=True),
+        ]
+        snapshot = cache.Snapshot(rows, ENVIRONMENTS)
+        assert snapshot.get(key="a", Published=True)["value"] == 1
+        with helpers.raises(tables.TableError):
+            snapshot.get(key="a", Debug=True)
+
+    def test_ttl(self):
+        assert not cache.Snapshot([], ENVIRONMENTS).expired
+        assert not cache.Snapshot([], ENVIRONMENTS, ttl=60).expired
+        assert cache.Snapshot([], ENVIRONMENTS, ttl=-1).expired
+
+    def test_patched(self):
+        backend = backends.MemoryBackend(
+            environments=ENVIRONMENTS,
+            rows=[_row("a", "default"), _row("a", "debug", Debug=True), _row("b", 1)],
+        )
+        snapshot = cache.Snapshot(backend.search(), ENVIRONMENTS)
+        assert snapshot.row_count == 3
+
+        debug, b = backend.rows[1], backend.rows[2]
+        debug.update(value="published", Debug=None, Published=True)
+        b.update(key="c")
+        (new,) = backend.add_rows([_row("d", 2)])
+        patched = snapshot.patched([debug, b, new])
+
+        assert patched.row_count == 4
+        assert patched.get(key="a", Debug=True) is None
+        assert patched.get(key="a", Published=True)["value"] == "published"
+        assert patched.get(key="b", Debug=None, Published=None) is None
+        assert patched.get(key="c", Debug=None, Published=None)["value"] == 1
+        assert patched.keys == {"a", "c", "d"}
+
+        # The original snapshot is unchanged
+        assert snapshot.get(key="a", Debug=True)["value"] == "debug"
+        assert snapshot.keys == {"a", "b"}
+
+    def test_mutable_values(self):
+        snapshot = cache.Snapshot([_row("a", {"b": [1]})], ENVIRONMENTS)
+        snapshot.get(key="a", Debug=None, Published=None)["value"]["b"].append(2)
+        assert snapshot.get(key="a", Debug=None, Published=None)["value"] == {"b": [1]}
+
+    def test_patched_without_ids(self):
+        snapshot = cache.Snapshot([_row("a", 1)], ENVIRONMENTS)
+        assert snapshot.patched([_row("a", 2)]) is None
+
+
+class TestNegativeCache:
+    def test_hit(self):
+        negative = cache.NegativeCache(ttl=60)
+        assert not negative.hit("a", "Debug")
+        negative.add("a", "Debug")
+        assert negative.hit("a", "Debug")
+        assert not negative.hit("a", "Published"), "Misses are per environment"
+        assert not negative.hit("a", None)
+
+    def test_expired(self):
+        negative = cache.NegativeCache(ttl=-1)
+        negative.add("a", None)
+        assert not negative.hit("a", None)
+
+    def test_discard(self):
+        negative = cache.NegativeCache(ttl=60)
+        negative.add("a", None)
+        negative.add("b", None)
+        negative.discard("a")
+        assert not negative.hit("a", None)
+        assert negative.hit("b", None)
+        negative.clear()
+        assert not negative.hit("b", None)
+
+    def test_maxsize(self):
+        negative = cache.NegativeCache(ttl=60, maxsize=2)
+        for name in ["a", "b", "c"]:
+            negative.add(name, None)
+        assert len(negative) == 2
+        assert not negative.hit("a", None), "The least recently missed name should be evicted"
+        assert negative.hit("c", None)
+
+    def test_expired_dropped(self):
+        negative = cache.NegativeCache(ttl=-1, maxsize=2)
+        for name in ["a", "b", "c"]:
+            negative.add(name, "Debug")
+        assert len(negative) == 0, "Expired names should be dropped when making room"
+
+
+class TestTTLCache:
+    def test_get_set(self):
+        ttl_cache = cache.TTLCache()
+        assert ttl_cache.get("a") is None
+        assert ttl_cache.get("a", 1) == 1
+        ttl_cache.set("a", 2, ttl=60)
+        assert ttl_cache.get("a") == 2
+
+    def test_expired(self):
+        ttl_cache = cache.TTLCache()
+        ttl_cache.set("a", 2, ttl=-1)
+        assert ttl_cache.get("a") is None
+        assert len(ttl_cache) == 0
+
+    def test_maxsize(self):
+        ttl_cache = cache.TTLCache(maxsize=2)
+        ttl_cache.set("a", 1, ttl=60)
+        ttl_cache.set("b", 2, ttl=60)
+        ttl_cache.get("a")
+        ttl_cache.set("c", 3, ttl=60)
+        assert len(ttl_cache) == 2
+        assert ttl_cache.get("b") is None, "The least recently used entry should be evicted"
+        assert ttl_cache.get("a") == 1
+        assert ttl_cache.get("c") == 3
+
+    def test_purge(self):
+        ttl_cache = cache.TTLCache()
+        ttl_cache.set("a", 1, ttl=60)
+        ttl_cache.set("b", 2, ttl=60)
+        ttl_cache.purge("a")
+        assert ttl_cache.get("a") is None
+        assert ttl_cache.get("b") == 2
+        ttl_cache.purge()
+        assert len(ttl_cache) == 0
+
+
+def _deferred(name, size=10):
+    return cache.Deferred(name, size, zlib.compress(b"null"))
+
+
+class TestValueCache:
+    def test_lru(self):
+        values = cache.ValueCache(max_bytes=20)
+        a, b, c = _deferred("a"), _deferred("b"), _deferred("c")
+        values.put(a, 1)
+        values.put(b, 2)
+        assert values.get(a) == 1
+        values.put(c, 3)
+        assert values.get(b) is None, "The least recently read value should be evicted"
+        assert values.get(a) == 1
+        assert values.get(c) == 3
+        assert values.stats["bytes"] == 20
+        assert values.stats["evictions"] == 1
+        assert values.stats["evicted_bytes"] == 10
+
+    def test_pinned(self):
+        values = cache.ValueCache(max_bytes=10, pinned={"a"})
+        a, b = _deferred("a"), _deferred("b")
+        values.put(a, 1)
+        values.put(b, 2)
+        assert values.get(a) == 1, "Pinned values are never evicted"
+        assert values.get(b) is None
+        values.unpin("a")
+        values.put(b, 2)
+        assert values.get(a) is None, "Unpinned values are evicted again"
+
+        values.pin("b")
+        values.put(a, 1)
+        assert values.get(b) == 2
+        assert values.get(a) is None
+        assert values.stats["pinned"] == 1
+
+    def test_discard(self):
+        values = cache.ValueCache(max_bytes=100)
+        a = _deferred("a")
+        values.put(a, 1)
+        values.discard(a)
+        assert values.get(a) is None
+        assert values.stats["bytes"] == 0
+        assert values.stats["evictions"] == 0
+
+    def test_sizeof(self):
+        small = cache.sizeof(1)
+        large = cache.sizeof({"routes": [{"path": f"/{i}", "weight": i} for i in range(100)]})
+        assert small < large
+        shared = ["x" * 1000]
+        assert cache.sizeof([shared, shared]) < 2 * cache.sizeof(shared), "Shared values are counted once"
+
+    def test_snapshot(self):
+        rows = [_row("flag", True), _row("routes", list(range(500))), _row("map", {str(i): i for i in range(500)})]
+        largest = max(cache.sizeof(list(range(500))), cache.sizeof({str(i): i for i in range(500)}))
+        values = cache.ValueCache(max_bytes=largest, resident_size=256)
+        snapshot = cache.Snapshot(rows, ENVIRONMENTS, values=values)
+        assert len(values) == 1, "Only one large value fits the budget"
+        assert snapshot._rows["flag"][0]["value"] is True, "Small values stay in the rows"
+
+        default = dict.fromkeys(ENVIRONMENTS)
+        assert snapshot.get(key="routes", **default)["value"] == list(range(500))
+        assert snapshot.get(key="map", **default)["value"] == {str(i): i for i in range(500)}
+        assert values.stats["misses"] == 2
+        assert snapshot.get(key="map", **default)["value"]["7"] == 7
+        assert values.stats["hits"] == 1
+
+    def test_items(self):
+        values = cache.ValueCache(max_bytes=0, resident_size=256)
+        snapshot = cache.Snapshot([_row("routes", list(range(500)))], ENVIRONMENTS, values=values)
+        ((_, row),) = snapshot.items()
+        assert isinstance(row["value"], cache.Encoded), "Evicted values are written without decoding them"
+        assert row["value"].decode() == list(range(500))
+        assert values.stats["misses"] == 0
+
+    def test_dropped_snapshot(self):
+        values = cache.ValueCache(max_bytes=10**6, resident_size=256)
+        snapshot = cache.Snapshot([_row("routes", list(range(500)))], ENVIRONMENTS, values=values)
+        assert len(values) == 1
+        newer = cache.Snapshot([_row("routes", list(range(500)))], ENVIRONMENTS, values=values)
+        assert len(values) == 2, "The older snapshot's values stay while it is in use"
+        del snapshot
+        assert len(values) == 1, "The older snapshot's values go with it"
+        assert values.stats["bytes"] == newer._rows["routes"][0]["value"].size
+
+    def test_raw_bytes(self):
+        values = cache.ValueCache(max_bytes=0, resident_size=256)
+        snapshot = cache.Snapshot([_row("routes", list(range(500)))], ENVIRONMENTS, values=values)
+        deferred = snapshot._rows["routes"][0]["value"]
+        stats = values.stats
+        assert stats["bytes"] == 0 and stats["evictions"] == 1, stats
+        assert stats["raw_bytes"] == len(deferred.raw), "The compressed value stays after eviction"
+        del snapshot, deferred
+        assert values.stats["raw_bytes"] == 0, "The compressed value goes with the snapshot"
+
+
+class TestSingleFlight:
+    def test_coalesce(self):
+        flights = cache.SingleFlight()
+        release = threading.Event()
+        calls = list()
+
+        def load():
+            calls.append(1)
+            release.wait(1)
+            return "value"
+
+        results = list()
+        threads = [threading.Thread(target=lambda: results.append(flights.do("key", load))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # Let every thread join the flight before it lands
+        while len(flights) == 0:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert results == ["value"] * 5
+        assert len(calls) == 1
+        assert len(flights) == 0
+
+    def test_error_shared(self):
+        flights = cache.SingleFlight()
+
+        def fail():
+            raise LookupError("missing")
+
+        with helpers.raises(LookupError):
+            flights.do("key", fail)
+        # Failures are not remembered
+        assert flights.do("key", lambda: "value") == "value"
+
+
+class TestRefresher:
+    def test_backoff(self):
+        refresher = cache.Refresher(lambda: None, interval=10, jitter=0, max_backoff=30)
+        assert refresher.delay() == 10
+        refresher.failures = 1
+        assert refresher.delay() == 20
+        refresher.failures = 5
+        assert refresher.delay() == 30, "Backoff should be capped"
+
+    def test_jitter(self):
+        refresher = cache.Refresher(lambda: None, interval=10, jitter=0.1)
+        assert all(9 <= refresher.delay() <= 11 for _ in range(100))
+
+    def test_failures(self):
+        outcomes = [LookupError("unreachable"), LookupError("unreachable"), None]
+
+        def refresh():
+            error = outcomes.pop(0)
+            if error is not None:
+                raise error
+
+        refresher = cache.Refresher(refresh, interval=10)
+        assert not refresher.refresh()
+        assert not refresher.refresh()
+        assert refresher.failures == 2
+        assert isinstance(refresher.last_error, LookupError)
+        assert refresher.refresh()
+        assert refresher.failures == 0
+        assert refresher.last_error is None
+        assert refresher.last_success is not None
+
+    def test_thread(self):
+        calls = list()
+        refresher = cache.Refresher(lambda: calls.append(1), interval=0.01, jitter=0)
+        refresher.start()
+        assert refresher.running
+        time.sleep(0.1)
+        refresher.stop(timeout=1)
+        assert not refresher.running
+        count = len(calls)
+        assert count > 1
+        time.sleep(0.05)
+        assert len(calls) == count, "No refreshes after stop"
@@ -1,6 +1,8 @@
 from anvil import _AppInfo
 
-from ...environ import models, src
+from ...environ import backends, models, src
+
+import time
 
 
 class _Mock:
@@ -8,6 +10,7 @@ class _Mock:
         # why the signature for environment uses 'description' but the object uses 'name' is beyond me... but here we are.
         self._environments_db = models.EnvDB("env")
         self._basic_db = models.EnvDB("basic_env")
+        self._snapshot_db = models.EnvDB("env", snapshot=True)
 
     def enable_environments(self):
         src.DB = self._environments_db
@@ -15,6 +18,14 @@ class _Mock:
     def disable_environments(self):
         src.DB = self._basic_db
 
+    def use_backend(self, backend, **options):
+        src.DB = models.EnvDB(backend.name, backend=backend, **options)
+        return src.DB
+
+    def enable_snapshot(self):
+        self._snapshot_db.invalidate()
+        src.DB = self._snapshot_db
+
     def debug(self, user='abc'):
         src.ENVIRONMENT._environment = _AppInfo._Environment(
             description=f"Debug for {user}@example.com", tags=["debug"]
@@ -32,3 +43,20 @@ class _Mock:
 
 
 _mock = _Mock()
+
+
+class _SlowBackend(backends.MemoryBackend):
+    """Searches take long enough for calls from other threads or tasks to overlap"""
+    def search(self, keys=None, any_of=None):
+        time.sleep(0.05)
+        return super().search(keys, any_of)
+
+
+def _memory_backend(backend=backends.MemoryBackend, extra=()):
+    """A url with a Debug override and a port in a Debug and Published table, followed by the extra rows"""
+    rows = [
+        {"key": "url", "value": "example.com"},
+        {"key": "url", "value": "debug.example.com", "Debug": True},
+        {"key": "port", "value": 8080},
+    ]
+    return backend(environments=["Debug", "Published"], rows=rows + list(extra))
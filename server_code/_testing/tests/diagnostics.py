@@ -0,0 +1,254 @@
+from anvil import tables
+
+from anvil_testing import helpers
+
+from ... import environ
+from ...environ import diagnostics, models, src
+
+from .conftest import _SlowBackend, _memory_backend, _mock
+
+import contextvars
+import threading
+
+
+class TestQueryCounter:
+    def test_record(self):
+        counter = diagnostics.QueryCounter()
+        counter.record("get")
+        counter.record("get")
+        counter.record("search")
+        assert counter["get"] == 2
+        assert counter.total == 3
+        assert "get=2" in str(counter)
+
+    def test_backend_restored(self):
+        db = _mock.use_backend(_memory_backend())
+        backend = db.backend
+        with environ.count_queries():
+            with environ.count_queries():
+                assert isinstance(db.backend, diagnostics.CountingBackend)
+        assert db.backend is backend
+        _mock.enable_environments()
+
+    def test_overlapping_blocks(self):
+        db = _mock.use_backend(_memory_backend())
+        backend = db.backend
+        outer = environ.count_queries()
+        first = outer.__enter__()
+        with environ.count_queries() as second:
+            outer.__exit__(None, None, None)
+            environ.get("port")
+        assert second["search"] == 1, second
+        assert first.total == 0, first
+        assert db.backend is backend
+        _mock.enable_environments()
+
+    def test_other_threads(self):
+        _mock.use_backend(_memory_backend())
+        with environ.count_queries() as queries:
+            thread = threading.Thread(target=environ.get, args=("port",))
+            thread.start()
+            thread.join()
+        assert queries.total == 0, f"Calls made by other threads are not counted {queries}"
+        _mock.enable_environments()
+
+    def test_set(self):
+        _mock.use_backend(_memory_backend())
+        environ.get("url")
+        with environ.count_queries() as queries:
+            environ.set("url", "new.example.com")
+        assert queries["get"] == 1, queries
+        assert queries["update"] == 1, queries
+        assert queries["upsert"] == 0, "The calls upsert makes are counted instead"
+        _mock.enable_environments()
+
+
+class TestQueryBudgets:
+    def test_get(self):
+        _mock.use_backend(_memory_backend())
+        _mock.debug()
+        environ.get("url")
+        with environ.count_queries() as queries:
+            assert environ.get("url") == "debug.example.com"
+        assert queries.total == 1, queries
+        assert queries["search"] == 1, "get should be a single search"
+        _mock.enable_environments()
+
+    def test_warm_snapshot_get(self):
+        _mock.use_backend(_memory_backend(), snapshot=True)
+        _mock.debug()
+        environ.get("url")
+        with environ.count_queries() as queries:
+            environ.get("url")
+            environ.get("port")
+            environ.get("missing", None)
+        assert queries.total == 0, f"A warm get should not make any calls {queries}"
+        _mock.enable_environments()
+
+    def test_get_many(self):
+        _mock.use_backend(_memory_backend())
+        _mock.published()
+        environ.get("url")
+        with environ.count_queries() as queries:
+            environ.get_many(["url", "port", "missing"], defaults={"missing": None})
+        assert queries.total == 1, queries
+        _mock.enable_environments()
+
+    def test_info(self):
+        _mock.use_backend(_memory_backend())
+        with environ.count_queries() as queries:
+            environ.info()
+        assert queries["list_columns"] <= 1, queries
+        _mock.enable_environments()
+
+    def test_set_many(self):
+        _mock.use_backend(_memory_backend())
+        environ.get("url")
+        with environ.count_queries() as queries:
+            environ.set_many({"url": "new.example.com", "new": 1, "other": 2})
+        assert queries["search"] == 1, queries
+        assert queries["update"] == 1, queries
+        assert queries["add_rows"] == 1, queries
+        assert queries.total == 3, queries
+        _mock.enable_environments()
+
+    def test_secret(self):
+        _mock.use_backend(_memory_backend(extra=[{"key": "secret", "value": models.Secret("test_secret")}]))
+        with environ.count_queries() as queries:
+            assert environ.get("secret") == "42"
+        assert queries["get_secret"] == 1, queries
+        _mock.enable_environments()
+
+
+class TestConcurrency:
+    def test_coalesced_misses(self):
+        _mock.use_backend(_memory_backend(_SlowBackend))
+        _mock.published()
+        environ.get("url")
+
+        start = threading.Barrier(8)
+        results = list()
+
+        def get():
+            start.wait()
+            results.append(environ.get("url"))
+
+        with environ.count_queries() as queries:
+            # Each thread runs in a copy of the block's context so its calls are counted
+            threads = [threading.Thread(target=contextvars.copy_context().run, args=(get,)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert results == ["example.com"] * 8
+        assert 1 <= queries["search"] < 8, f"Concurrent misses should share searches {queries}"
+        _mock.enable_environments()
+
+    def test_snapshot_reload(self):
+        db = _mock.use_backend(_memory_backend(_SlowBackend), snapshot=True)
+        _mock.published()
+        environ.get("url")
+        db.invalidate()
+
+        start = threading.Barrier(8)
+        with environ.count_queries() as queries:
+            threads = [
+                threading.Thread(
+                    target=contextvars.copy_context().run, args=(lambda: (start.wait(), environ.get("port")),)
+                )
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert queries["search"] == 1, f"A stale snapshot should be reloaded once {queries}"
+        _mock.enable_environments()
+
+
+class TestMetrics:
+    def _setup(self, **options):
+        self.variables = src.VARIABLES
+        src.VARIABLES = models.Variables()
+        _mock.use_backend(_memory_backend(extra=[{"key": "secret", "value": models.Secret("test_secret")}]), **options)
+        _mock.debug()
+        return src.VARIABLES.metrics
+
+    def _teardown(self):
+        src.VARIABLES = self.variables
+        _mock.enable_environments()
+
+    def test_disabled(self):
+        metrics = self._setup()
+        try:
+            environ.get("url")
+            assert metrics.as_dict()["reads"] == {}
+            assert metrics.start() is None
+            assert str(metrics) == "Metrics: disabled"
+        finally:
+            self._teardown()
+
+    def test_reads_and_cache(self):
+        metrics = self._setup(snapshot=True, negative_ttl=60)
+        metrics.enable()
+        try:
+            environ.get("url")
+            environ.get("url")
+            environ.get("missing", None)
+            src.DB.disable_snapshot()
+            environ.get("missing", None)
+            environ.get_many(["port"])
+
+            exported = metrics.as_dict()
+            assert exported["reads"] == {"url": 2, "missing": 2, "port": 1}, exported["reads"]
+            assert exported["cache"]["miss"] == 2, exported["cache"]
+            assert exported["cache"]["hit"] == 2, exported["cache"]
+            assert exported["cache"]["negative_hit"] == 1, exported["cache"]
+            assert exported["cache"]["hit_ratio"] == 0.4
+            assert exported["latency"]["table"]["count"] == 2
+            assert sum(exported["latency"]["table"]["histogram"].values()) == 2
+        finally:
+            self._teardown()
+
+    def test_overlap_errors(self):
+        metrics = self._setup()
+        metrics.enable()
+        try:
+            src.DB.backend.add_rows([{"key": "overlap", "value": 1, "Debug": True}] * 2)
+            with helpers.raises(tables.TableError):
+                environ.get("overlap")
+            assert metrics.overlap_errors == 1
+            metrics.reset()
+            assert metrics.overlap_errors == 0
+        finally:
+            self._teardown()
+
+    def test_threads(self):
+        metrics = diagnostics.Metrics(enabled=True)
+
+        def record():
+            for _ in range(1000):
+                metrics.read("url")
+                metrics.cache_result("hit")
+                metrics.observe("table", metrics.start())
+
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        exported = metrics.as_dict()
+        assert exported["reads"] == {"url": 8000}, "Concurrent reads shouldn't be lost"
+        assert exported["cache"]["hit"] == 8000
+        assert exported["latency"]["table"]["count"] == 8000
+
+    def test_secret_latency(self):
+        metrics = self._setup()
+        metrics.enable()
+        try:
+            environ.get("secret")
+            assert metrics.as_dict()["latency"]["secret"]["count"] == 1
+        finally:
+            self._teardown()
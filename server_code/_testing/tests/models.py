@@ -2,7 +2,17 @@ import anvil.tables
 
 from anvil_testing import helpers
 
-from ...environ import models, src
+from ... import environ
+from ...environ import backends, cache, models, src
+
+from .conftest import _memory_backend, _mock
+
+from contextlib import contextmanager
+from datetime import timedelta
+import os
+import tempfile
+import threading
+import time
 
 
 class TestEnvDB:
@@ -18,6 +28,482 @@ class TestEnvDB:
         assert not db.is_ready, "should not be ready"
         assert db.table is None, "should not return a table"
         assert db._missing_table_columns() == db.required_columns, "Should require all of the columns"
+        assert not db.environments, "Should not have any environments"
+
+    def test_schema(self):
+        db = models.EnvDB('env')
+        schema = db.schema
+        assert schema is db.schema, "The schema should only be fetched once"
+        assert schema.is_ready
+        assert {"key", "value"} <= set(schema.columns)
+        assert {"Debug", "Published"} <= schema.environments
+        assert db.environments is schema.environments
+
+        db.refresh_schema()
+        assert db.schema is not schema, "The schema should be fetched again after a refresh"
+        assert db.schema == schema
+
+
+class _FlakyBackend(backends.MemoryBackend):
+    unreachable = False
+
+    def search(self, keys=None, any_of=None):
+        if self.unreachable:
+            raise anvil.tables.TableError("unreachable")
+        return super().search(keys, any_of)
+
+
+class TestRefresher:
+    def _db(self):
+        backend = _FlakyBackend(environments=["Published"], rows=[{"key": "url", "value": "example.com"}])
+        return backend, models.EnvDB("env", backend=backend)
+
+    def test_serves_last_good_snapshot(self):
+        backend, db = self._db()
+        db.start_refresher(interval=0.01, jitter=0)
+        try:
+            assert db.snapshot_enabled
+            assert db.snapshot.get(key="url", Published=None)["value"] == "example.com"
+            assert db.healthy
+
+            backend.unreachable = True
+            time.sleep(0.1)
+            assert not db.healthy, "A failing refresher should be reported"
+            assert "unreachable" in str(db)
+            assert db.snapshot.get(key="url", Published=None)["value"] == "example.com"
+
+            backend.unreachable = False
+            backend.add_rows([{"key": "port", "value": 8080}])
+            # Backoff can be a few intervals by now
+            time.sleep(0.5)
+            assert db.healthy
+            assert db.snapshot.get(key="port", Published=None)["value"] == 8080
+        finally:
+            db.stop_refresher()
+        assert db.refresher is None
+
+    def test_max_staleness(self):
+        backend, db = self._db()
+        db.start_refresher(interval=60, max_staleness=0.05)
+        try:
+            db.snapshot
+            backend.unreachable = True
+            time.sleep(0.1)
+            assert not db.healthy
+            with helpers.raises(anvil.tables.TableError):
+                db.snapshot
+        finally:
+            db.stop_refresher()
+
+    def test_restores_ttl(self):
+        _, db = self._db()
+        db.enable_snapshot(ttl=30)
+        db.start_refresher(interval=60)
+        try:
+            assert db.snapshot_ttl is None
+            db.snapshot
+        finally:
+            db.stop_refresher()
+        assert db.snapshot_ttl == 30, "The ttl should be restored once the refresher stops"
+        assert db.snapshot.ttl == 30
+
+
+class _ConflictBackend(backends.MemoryBackend):
+    """Raises a transaction conflict for the first few transactions, before anything is written"""
+    def __init__(self, conflicts, **kwargs):
+        super().__init__(**kwargs)
+        self.conflicts = conflicts
+
+    @contextmanager
+    def transaction(self):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise anvil.tables.TransactionConflict("Another transaction has changed this data")
+        yield
+
+
+class TestVersionMarker:
+    def test_bump(self):
+        db = models.EnvDB("env", backend=backends.MemoryBackend(environments=["Published"]))
+        assert db.version is None
+        assert db.bump_version() == 1
+        assert db.bump_version() == 2
+        assert db.version == 2
+        assert len(db.backend.search(keys=[models.VERSION_KEY])) == 1, "Only one marker row"
+
+    def test_revalidate(self):
+        backend = backends.MemoryBackend(environments=["Published"], rows=[{"key": "url", "value": "example.com"}])
+        db = models.EnvDB("env", backend=backend, snapshot=True, snapshot_ttl=0, version_marker=True)
+        db.bump_version()
+        snapshot = db.snapshot
+
+        with environ.count_queries(db) as queries:
+            assert db.snapshot is snapshot, "An unchanged marker should keep the snapshot"
+        assert queries["search"] == 0, queries
+        assert queries["get"] == 1, queries
+
+        # Another process edits the table
+        other = models.EnvDB("env", backend=backend)
+        other.backend.upsert({"key": "url", "Published": None}, {"value": "edited.example.com"})
+        other.bump_version()
+        assert db.snapshot is not snapshot
+        assert db.snapshot.get(key="url", Published=None)["value"] == "edited.example.com"
+
+    def test_conflict(self):
+        db = models.EnvDB("env", backend=_ConflictBackend(conflicts=2, environments=["Published"]))
+        assert db.bump_version() == 1, "A conflict should be retried"
+        assert db.backend.conflicts == 0
+
+        db.backend.conflicts = models.VERSION_RETRIES
+        with helpers.raises(anvil.tables.TransactionConflict):
+            db.bump_version()
+
+    def test_set_conflict(self):
+        backend = _ConflictBackend(conflicts=0, environments=["Published"])
+        _mock.use_backend(backend, version_marker=True)
+        environ.set("url", "example.com")
+        backend.conflicts = models.VERSION_RETRIES
+        environ.set("url", "edited.example.com")
+        assert environ.get("url") == "edited.example.com", "set should not fail once the value is written"
+        _mock.enable_environments()
+
+    def test_set_bumps(self):
+        db = _mock.use_backend(backends.MemoryBackend(environments=["Published"]), version_marker=True)
+        environ.set("url", "example.com")
+        environ.set_many({"url": "example.com", "port": 8080})
+        assert db.version == 2
+        assert environ.bump_version() == 3
+        _mock.enable_environments()
+
+
+class TestDeltaRefresh:
+    def _backend(self):
+        columns = {"key": "string", "value": "simpleObject", "info": "string", "updated": "datetime", "Published": "bool"}
+        return backends.MemoryBackend(
+            columns=columns,
+            rows=[
+                {"key": "url", "value": "example.com", "updated": models.now()},
+                {"key": "port", "value": 8080, "updated": models.now()},
+            ],
+        )
+
+    def test_set(self):
+        db = _mock.use_backend(self._backend(), snapshot=True)
+        _mock.published()
+        assert db.delta_enabled
+        assert environ.get("url") == "example.com"
+
+        environ.set("url", "edited.example.com")
+        environ.set("new", "value")
+        with environ.count_queries() as queries:
+            assert environ.get("url") == "edited.example.com"
+            assert environ.get("new") == "value"
+            assert environ.get("port") == 8080
+        assert queries["search"] == 0, f"Only the changed rows should be fetched {queries}"
+        assert queries["changed_since"] == 1, queries
+        _mock.enable_environments()
+
+    def test_clock_behind(self):
+        backend = self._backend()
+        db = _mock.use_backend(backend, snapshot=True)
+        _mock.published()
+        assert environ.get("url") == "example.com"
+
+        # Written by a process whose clock is behind the one that stamped the snapshot
+        backend.rows[0].update(value="edited.example.com", updated=db.snapshot.updated - timedelta(seconds=2))
+        db.invalidate()
+        with environ.count_queries() as queries:
+            assert environ.get("url") == "edited.example.com"
+        assert queries["search"] == 0, f"The edit should be picked up by a delta refresh {queries}"
+        _mock.enable_environments()
+
+    def test_other_updated_column(self):
+        columns = {"key": "string", "value": "simpleObject", "info": "string", "updated": "string", "Published": "bool"}
+        backend = backends.MemoryBackend(columns=columns)
+        db = _mock.use_backend(backend, version_marker=True)
+        assert not db.delta_enabled
+        environ.set("url", "example.com")
+        environ.set_many({"port": 8080})
+        assert all(row.get("updated") is None for row in backend.rows), "Only a datetime column is stamped"
+        _mock.enable_environments()
+
+    def test_bump_version(self):
+        backend = self._backend()
+        _mock.use_backend(backend, snapshot=True)
+        _mock.published()
+        assert environ.get("url") == "example.com"
+
+        # Edited by hand, without an updated stamp
+        backend.rows[0]["value"] = "edited.example.com"
+        environ.bump_version()
+        with environ.count_queries() as queries:
+            assert environ.get("url") == "edited.example.com"
+        assert queries["search"] == 1, f"bump_version should force a full reload {queries}"
+        _mock.enable_environments()
+
+    def test_marker_moved(self):
+        backend = self._backend()
+        db = _mock.use_backend(backend, snapshot=True, snapshot_ttl=0, version_marker=True)
+        _mock.published()
+        db.bump_version()
+        assert environ.get("url") == "example.com"
+
+        # Another process edits a row by hand and moves the marker
+        backend.rows[0]["value"] = "edited.example.com"
+        models.EnvDB("env", backend=backend).bump_version()
+        assert environ.get("url") == "edited.example.com", "A moved marker should reload the whole table"
+        _mock.enable_environments()
+
+    def test_deleted_row(self):
+        backend = self._backend()
+        db = _mock.use_backend(backend, snapshot=True)
+        _mock.published()
+        assert environ.get("port") == 8080
+
+        row = backend.rows.pop()
+        backend._by_key.pop(row["key"])
+        db.invalidate()
+        with environ.count_queries() as queries:
+            assert environ.get("port", None) is None
+        assert queries["search"] == 1, f"A deleted row should fall back to a full reload {queries}"
+        _mock.enable_environments()
+
+
+class TestValueCache:
+    def _backend(self):
+        return backends.MemoryBackend(
+            environments={"Published"},
+            rows=[
+                {"key": "url", "value": "example.com"},
+                {"key": "flags", "value": {f"flag_{i}": True for i in range(200)}},
+                {"key": "routes", "value": [f"/route/{i}" for i in range(200)]},
+            ],
+        )
+
+    def test_budget(self):
+        db = _mock.use_backend(self._backend(), snapshot=True)
+        _mock.published()
+        db.enable_value_cache(max_bytes=cache.sizeof([f"/route/{i}" for i in range(200)]))
+        assert environ.get("url") == "example.com"
+        with environ.count_queries() as queries:
+            assert environ.get("url") == "example.com"
+            assert len(environ.get("flags")) == 200
+            assert len(environ.get("routes")) == 200
+            assert len(environ.get("flags")) == 200
+        assert queries["search"] == 0, queries
+        assert queries["get"] == 0, f"Evicted values are decoded again without a query {queries}"
+        stats = db.value_cache.stats
+        assert stats["evictions"] >= 2, stats
+        assert stats["bytes"] <= stats["max_bytes"], stats
+        assert "Value cache" in str(db)
+        db.disable_value_cache()
+        _mock.enable_environments()
+
+    def test_pinned(self):
+        db = _mock.use_backend(self._backend(), snapshot=True)
+        _mock.published()
+        db.enable_value_cache(max_bytes=0, pinned={"flags"})
+        assert len(environ.get("flags")) == 200
+        with environ.count_queries() as queries:
+            assert len(environ.get("flags")) == 200
+        assert queries["get"] == 0, f"Pinned values stay in memory {queries}"
+        db.disable_value_cache()
+        _mock.enable_environments()
+
+    def test_export(self):
+        db = _mock.use_backend(self._backend(), snapshot=True)
+        _mock.published()
+        db.enable_value_cache(max_bytes=0)
+        path = os.path.join(tempfile.mkdtemp(), "env.snapshot")
+        assert environ.get("url") == "example.com"
+        with environ.count_queries() as queries:
+            environ.export_snapshot(path)
+        assert queries["get"] == 0 and queries["search"] == 0, queries
+
+        db.load_snapshot(path, verify=False)
+        assert len(environ.get("routes")) == 200
+        db.disable_value_cache()
+        _mock.enable_environments()
+
+
+class TestSnapshotFile:
+    def _backend(self):
+        return _memory_backend(extra=[{"key": "secret", "value": models.Secret("test_secret")}])
+
+    def test_round_trip(self):
+        backend = self._backend()
+        path = os.path.join(tempfile.mkdtemp(), "env.snapshot")
+        models.EnvDB("env", backend=backend, version_marker=True).bump_version()
+        models.EnvDB("env", backend=backend).export_snapshot(path)
+
+        db = _mock.use_backend(backend)
+        _mock.debug()
+        with environ.count_queries() as queries:
+            assert environ.load_snapshot(path, verify=False)
+            assert environ.get("url") == "debug.example.com"
+            assert models.Secret._is_secret(db.snapshot.get(key="secret", Debug=None, Published=None)["value"])
+        assert queries.total == 0, f"Starting from a file should not query the table {queries}"
+        _mock.enable_environments()
+
+    def test_lazy_values(self):
+        path = os.path.join(tempfile.mkdtemp(), "env.snapshot")
+        models.EnvDB("env", backend=self._backend()).export_snapshot(path)
+        header, rows = cache.load_snapshot(path)
+        assert header["table"] == "env"
+        assert all(isinstance(row["value"], cache.Encoded) for row in rows)
+
+    def test_verify(self):
+        backend = self._backend()
+        path = os.path.join(tempfile.mkdtemp(), "env.snapshot")
+        writer = models.EnvDB("env", backend=backend, version_marker=True)
+        writer.bump_version()
+        writer.export_snapshot(path)
+
+        db = models.EnvDB("env", backend=backend)
+        assert db.load_snapshot(path), "The file matches the version marker"
+
+        writer.backend.upsert({"key": "url", "Debug": None, "Published": None}, {"value": "edited.example.com"})
+        writer.bump_version()
+        assert not db.load_snapshot(path), "The file is behind the version marker"
+        assert db.snapshot.get(key="url", Debug=None, Published=None)["value"] == "edited.example.com"
+
+    def test_wrong_table(self):
+        path = os.path.join(tempfile.mkdtemp(), "env.snapshot")
+        models.EnvDB("env", backend=self._backend()).export_snapshot(path)
+        with helpers.raises(ValueError):
+            models.EnvDB("other", backend=self._backend()).load_snapshot(path)
+
+    def test_corrupt(self):
+        path = os.path.join(tempfile.mkdtemp(), "env.snapshot")
+        models.EnvDB("env", backend=self._backend()).export_snapshot(path)
+        with open(path, "ab") as f:
+            f.write(b" ")
+        with helpers.raises(ValueError):
+            models.EnvDB("env", backend=self._backend()).load_snapshot(path)
+
+
+class TestSharedSnapshot:
+    def _backend(self):
+        return backends.MemoryBackend(environments=["Published"], rows=[{"key": "url", "value": "example.com"}])
+
+    def test_leader_publishes(self):
+        backend = self._backend()
+        path = os.path.join(tempfile.mkdtemp(), "env.snapshot")
+        leader = models.EnvDB("env", backend=backend)
+        follower = models.EnvDB("env", backend=backend)
+        leader.share_snapshot(path)
+        follower.share_snapshot(path)
+        try:
+            assert leader.snapshot.get(key="url", Published=None)["value"] == "example.com"
+            assert leader.shared.is_leader
+
+            with environ.count_queries(follower) as queries:
+                assert follower.snapshot.get(key="url", Published=None)["value"] == "example.com"
+            assert queries.total == 0, f"A follower should read the published snapshot {queries}"
+            assert not follower.shared.is_leader
+
+            # A write from the follower is seen by the follower and published by the leader
+            follower.backend.upsert({"key": "url", "Published": None}, {"value": "edited.example.com"})
+            follower.invalidate()
+            assert follower.snapshot.get(key="url", Published=None)["value"] == "edited.example.com"
+            generation = leader.shared.state[0]
+            assert leader.snapshot.get(key="url", Published=None)["value"] == "edited.example.com"
+            assert leader.shared.state[0] == generation + 1
+        finally:
+            leader.stop_sharing()
+            follower.stop_sharing()
+
+    def test_concurrent_counters(self):
+        path = os.path.join(tempfile.mkdtemp(), "env.snapshot")
+        # Separate instances lock like separate processes
+        leader, follower = cache.SharedSnapshot(path), cache.SharedSnapshot(path)
+        try:
+            def publish():
+                for _ in range(20):
+                    leader.publish(cache.Snapshot([], set()), {})
+
+            def request():
+                for _ in range(200):
+                    follower.request_refresh()
+
+            threads = [threading.Thread(target=publish)] + [threading.Thread(target=request) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert leader.state == (20, 800), "Neither counter should lose a move"
+        finally:
+            leader.close()
+            follower.close()
+
+    def test_takeover(self):
+        path = os.path.join(tempfile.mkdtemp(), "env.snapshot")
+        leader = models.EnvDB("env", backend=self._backend())
+        follower = models.EnvDB("env", backend=self._backend())
+        leader.share_snapshot(path)
+        follower.share_snapshot(path)
+        try:
+            leader.snapshot
+            follower.snapshot
+            assert not follower.shared.is_leader
+
+            leader.stop_sharing()
+            follower.revalidate()
+            assert follower.shared.is_leader, "The lock should pass to the next process"
+        finally:
+            follower.stop_sharing()
+
+
+class TestUsageProfile:
+    def test_file(self):
+        path = os.path.join(tempfile.mkdtemp(), "usage.json")
+        db = models.EnvDB("env", backend=backends.MemoryBackend())
+        profile = models.UsageProfile(db, path)
+        assert profile.names() == []
+        for name in ["a", "b", "b", "c", "c", "c"]:
+            profile.record(name)
+        profile.save()
+        assert profile.reads == {}, "Saved reads should not be counted twice"
+
+        profile = models.UsageProfile(db, path)
+        profile.record("a")
+        profile.save()
+        assert profile.load() == {"a": 2, "b": 2, "c": 3}
+        assert profile.names(limit=1) == ["c"]
+
+    def test_table(self):
+        db = models.EnvDB("env", backend=backends.MemoryBackend(environments=["Published"]))
+        profile = models.UsageProfile(db)
+        profile.record("a")
+        profile.save()
+        profile.record("a")
+        profile.save()
+        assert models.UsageProfile(db).load() == {"a": 2}
+        assert len(db.backend.search(keys=[models.USAGE_KEY])) == 1
+
+
+class TestEnvironmentResolver:
+    def test_direct_match(self):
+        resolver = models.EnvironmentResolver({"Debug", "Debug for abc@example.com", "Published"})
+        assert resolver.resolve("Published") == "Published"
+        assert resolver.resolve("Debug for abc@example.com") == "Debug for abc@example.com"
+
+    def test_prefix_match(self):
+        resolver = models.EnvironmentResolver({"Debug", "Debug for abc@example.com", "Published"})
+        assert resolver.resolve("Debug for bob@example.com") == "Debug"
+        assert resolver.resolve("Staging") is None
+
+    def test_ambiguous_memoized(self):
+        resolver = models.EnvironmentResolver({"P", "Pub", "Debug"})
+        for _ in range(2):
+            with helpers.raises(LookupError):
+                resolver.resolve("Published")
+        assert "Published" in resolver._memo
+
+    def test_db_resolver(self):
+        db = models.EnvDB('env')
+        assert db.resolver is db.resolver, "The resolver should be built once"
+        assert db.resolver.environments == db.environments
 
 
 class TestSecret:
@@ -28,6 +514,27 @@ class TestSecret:
             row = src.DB.table.add_row(key=name, value=secret)
             assert row['value'] is not None, "'value' should have something in there"
             assert models.Secret._is_secret(row['value']), f"{row['value']} should be seen as a secret"
+
+    def test_not_cached_by_default(self):
+        secret = models.Secret("test_secret")
+        assert secret._get_secret() == "42"
+        assert len(models.Secret._cache) == 0, "Secrets should not be cached unless enabled"
+
+    def test_cache(self):
+        secret = models.Secret("test_secret")
+        models.Secret.enable_cache(ttl=60, secret_name="test_secret")
+        try:
+            assert secret._get_secret() == "42"
+            assert models.Secret._cache.get("test_secret") == "42"
+
+            models.Secret._cache.set("test_secret", "cached", ttl=60)
+            assert secret._get_secret() == "cached", "Expected the cached value"
+
+            models.Secret.purge_cache("test_secret")
+            assert secret._get_secret() == "42"
+        finally:
+            models.Secret.disable_cache()
+        assert len(models.Secret._cache) == 0
         
 
 class TestVariable:
@@ -68,6 +575,17 @@ class TestVariable:
         a.value = 1234
         assert '1234' in a.details
 
+    def test_slots(self):
+        variable = models.Variable('a', 10)
+        with helpers.raises(AttributeError):
+            variable.other = 1
+
+    def test_equality(self):
+        assert models.Variable('a', 10) == models.Variable('a', 20)
+        assert models.Variable('a', 10) == 'a'
+        assert models.Variable('a', 10) != models.Variable('b', 10)
+        assert models.Variable('a', 10) != 1
+
 
 class TestVariables:
     def test_empty(self):
@@ -132,4 +650,42 @@ class TestVariables:
         assert d in VARIABLES.available
         for var in [a, b, c, d]:
             assert var in VARIABLES.all
-        
\ No newline at end of file
+
+    def test_moves_between_indexes(self):
+        VARIABLES = models.Variables()
+        VARIABLES._register(models.Variable('a', 10))
+        assert 'a' in VARIABLES.available
+
+        a = models.Variable('a', 10)
+        a.value = 20
+        VARIABLES._register(a)
+        assert 'a' in VARIABLES.in_use
+        assert 'a' not in VARIABLES.available
+        assert len(VARIABLES.all) == 1
+
+        VARIABLES._register(models.Variable('a', 10))
+        assert 'a' in VARIABLES.available
+        assert 'a' not in VARIABLES.in_use
+
+    def test_views_are_live(self):
+        VARIABLES = models.Variables()
+        in_use = VARIABLES.in_use
+        a = models.Variable('a', 10)
+        a.value = 10
+        VARIABLES._register(a)
+        assert len(in_use) == 1
+        assert in_use is VARIABLES.in_use
+        assert in_use == {a}
+        assert in_use & {'a', 'b'} == {'a'}
+
+    def test_register_while_iterating(self):
+        VARIABLES = models.Variables()
+        VARIABLES._register(models.Variable('a', 10))
+        for i, variable in enumerate(VARIABLES.all):
+            VARIABLES._register(models.Variable(f'new_{i}', 10))
+        assert len(VARIABLES.all) == 2
+
+    def test_unhashable_membership(self):
+        VARIABLES = models.Variables()
+        VARIABLES._register(models.Variable('a', 10))
+        assert ['a'] not in VARIABLES.all
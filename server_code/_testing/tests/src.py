@@ -1,11 +1,16 @@
 from anvil import tables
+import anvil.secrets
 
 from anvil_testing import helpers
 
 from ... import environ
-from ...environ import models, src
+from ...environ import backends, models, src
 
-from .conftest import _mock
+from .conftest import _memory_backend, _mock
+
+import os
+import tempfile
+import time
 
 
 class TestNormalizeEnvironmentRequest:
@@ -75,6 +80,30 @@ class TestResolveEnvironment:
             src.resolve_environment("A", {"A1", "AA", "B"})
 
 
+class TestSelectRow:
+    def __init__(self):
+        self.rows = [
+            {"key": "a", "value": 1, "A": True, "B": None},
+            {"key": "a", "value": 2, "A": None, "B": None},
+            {"key": "a", "value": 3, "A": True, "B": True},
+        ]
+
+    def test_default(self):
+        row = src._select_row(self.rows, {"key": "a", "A": None, "B": None})
+        assert row["value"] == 2
+
+    def test_environment(self):
+        row = src._select_row(self.rows, {"key": "a", "B": True})
+        assert row["value"] == 3
+
+    def test_no_match(self):
+        assert src._select_row(self.rows, {"key": "b", "A": True}) is None
+
+    def test_overlap(self):
+        with helpers.raises(tables.TableError):
+            src._select_row(self.rows, {"key": "a", "A": True})
+
+
 class TestGet:
     def test_error(self):
         _mock.disable_environments()
@@ -186,6 +215,313 @@ class TestGet:
                 environ.get(variable_name) == "DefaultValue"
             ), f"Didn't get the expected value for {src.ENVIRONMENT.name} env: {var}"
 
+    def test_snapshot(self):
+        _mock.enable_snapshot()
+        _mock.published()
+
+        variable_name = "test_snapshot_4c1d2a7e"
+        with helpers.temp_writes():
+            environ.set(variable_name, "PublishedValue", environments={"Published": True})
+            environ.set(variable_name, "DefaultValue")
+
+            assert environ.get(variable_name) == "PublishedValue"
+            _mock.staging()
+            assert environ.get(variable_name) == "DefaultValue"
+
+            # Edits made directly to the table are not seen until the snapshot is refreshed
+            src.DB.table.get(key=variable_name, Published=True)["value"] = "EditedValue"
+            _mock.published()
+            assert environ.get(variable_name) == "PublishedValue"
+
+            src.DB.refresh()
+            assert environ.get(variable_name) == "EditedValue"
+
+    def test_snapshot_mutable_value(self):
+        _mock.use_backend(backends.MemoryBackend(rows=[{"key": "flags", "value": {"a": 1}}]), snapshot=True)
+        flags = environ.get("flags")
+        flags["a"] = 999
+        assert environ.get("flags") == {"a": 1}, "Changing a returned value shouldn't change the snapshot"
+        _mock.enable_environments()
+
+
+class TestNegativeCache:
+    def test_set_clears_miss(self):
+        db = models.EnvDB("env", negative_ttl=60)
+        src.DB = db
+        _mock.published()
+
+        variable_name = "test_negative_cache_71b3"
+        with helpers.temp_writes():
+            assert environ.get(variable_name, "CodeDefault") == "CodeDefault"
+            assert db.negative_cache.hit(variable_name, "Published")
+
+            # Rows added behind environ's back are not seen while the miss is remembered
+            db.table.add_row(key=variable_name, value="TableValue")
+            assert environ.get(variable_name, "CodeDefault") == "CodeDefault"
+
+            environ.set(variable_name, "SetValue", environments={"Published": True})
+            assert not db.negative_cache.hit(variable_name, "Published")
+            assert environ.get(variable_name, "CodeDefault") == "SetValue"
+
+        _mock.enable_environments()
+
+
+class TestRequestSnapshot:
+    def test_consistent_reads(self):
+        backend = _memory_backend()
+        _mock.use_backend(backend)
+        _mock.debug()
+        with environ.snapshot():
+            assert environ.get("url") == "debug.example.com"
+            # Rows changed behind environ's back are not seen until the block ends
+            backend.rows[1]["value"] = "edited.example.com"
+            with environ.count_queries() as queries:
+                assert environ.get("url") == "debug.example.com"
+                assert environ.get_many(["url"]) == {"url": "debug.example.com"}
+                with environ.snapshot():
+                    assert environ.get("url") == "debug.example.com"
+            assert queries.total == 0, queries
+        assert environ.get("url") == "edited.example.com"
+        _mock.enable_environments()
+
+    def test_consistent_keys(self):
+        backend = _memory_backend()
+        _mock.use_backend(backend)
+        _mock.published()
+        with environ.snapshot():
+            assert environ.get("url") == "example.com"
+            # Edits made after the first read aren't seen by variables read later in the block
+            backend.rows[0]["value"] = "edited.example.com"
+            backend.rows[2]["value"] = 9090
+            with environ.count_queries() as queries:
+                assert environ.get("port") == 8080
+                assert environ.get_many(["url", "port"]) == {"url": "example.com", "port": 8080}
+            assert queries.total == 0, queries
+        assert environ.get("port") == 9090
+        _mock.enable_environments()
+
+    def test_missing(self):
+        _mock.use_backend(_memory_backend())
+        _mock.published()
+        with environ.snapshot():
+            assert environ.get("missing", None) is None
+            with environ.count_queries() as queries:
+                assert environ.get("missing", "CodeDefault") == "CodeDefault"
+                with helpers.raises(LookupError):
+                    environ.get("missing")
+            assert queries.total == 0, queries
+        _mock.enable_environments()
+
+    def test_mutable_value(self):
+        _mock.use_backend(backends.MemoryBackend(rows=[{"key": "flags", "value": {"a": 1}}]))
+        with environ.snapshot():
+            environ.get("flags")["a"] = 999
+            flags = environ.get("flags")
+            assert flags == {"a": 1}, "Changing a returned value shouldn't change the request view"
+            flags["a"] = 999
+            assert environ.get("flags") == {"a": 1}
+        _mock.enable_environments()
+
+    def test_set(self):
+        _mock.use_backend(_memory_backend())
+        _mock.published()
+        with environ.snapshot():
+            assert environ.get("url") == "example.com"
+            environ.set("url", "set.example.com")
+            assert environ.get("url") == "set.example.com"
+        _mock.enable_environments()
+
+
+class TestResolveAll:
+    def _backend(self):
+        return _memory_backend(
+            extra=[
+                {"key": "debug_only", "value": True, "Debug": True},
+                {"key": "secret", "value": models.Secret("test_secret")},
+            ]
+        )
+
+    def test_environments(self):
+        _mock.use_backend(self._backend())
+        with environ.count_queries() as queries:
+            debug = environ.resolve_all("Debug for abc@example.com")
+        assert queries["search"] == 1, queries
+        assert debug == {
+            "debug_only": True, "port": 8080, "secret": models.Secret("test_secret"), "url": "debug.example.com"
+        }
+        assert isinstance(debug["secret"], models.Secret), "Secrets should stay pointers"
+
+        published = environ.resolve_all("Published")
+        assert published == {"port": 8080, "secret": models.Secret("test_secret"), "url": "example.com"}
+        assert environ.resolve_all("Staging") == published, "Unmatched environments use the default rows"
+        _mock.enable_environments()
+
+    def test_current_environment(self):
+        _mock.use_backend(self._backend(), snapshot=True)
+        _mock.debug()
+        variables, src.VARIABLES = src.VARIABLES, models.Variables()
+        try:
+            assert environ.resolve_all()["url"] == "debug.example.com"
+            assert not src.VARIABLES.all, "resolve_all should not register variables"
+        finally:
+            src.VARIABLES = variables
+        _mock.enable_environments()
+
+    def test_overlap(self):
+        backend = self._backend()
+        backend.add_rows([{"key": "url", "value": "published.example.com", "Debug": True, "Published": True}])
+        _mock.use_backend(backend)
+        with helpers.raises(tables.TableError):
+            environ.resolve_all("Debug")
+        _mock.enable_environments()
+
+
+class TestPrefetch:
+    def _backend(self):
+        return _memory_backend(
+            extra=[
+                {"key": "key_a", "value": models.Secret("secret_a")},
+                {"key": "key_b", "value": models.Secret("secret_b")},
+                {"key": "key_broken", "value": models.Secret("secret_broken")},
+            ]
+        )
+
+    def _get_secret(self, name):
+        time.sleep(0.1)
+        if name == "secret_broken":
+            raise anvil.secrets.SecretError(f"No secret called {name}")
+        return f"value of {name}"
+
+    def test_prefetch(self):
+        _mock.use_backend(self._backend())
+        _mock.published()
+        get_secret, anvil.secrets.get_secret = anvil.secrets.get_secret, self._get_secret
+        try:
+            start = time.monotonic()
+            failures = environ.prefetch(["url", "key_a", "key_b", "key_broken", "missing"])
+            assert time.monotonic() - start < 0.25, "Secrets should be fetched concurrently"
+            assert list(failures) == ["key_broken"]
+            assert isinstance(failures["key_broken"], anvil.secrets.SecretError)
+
+            with environ.count_queries() as queries:
+                assert environ.get("key_a") == "value of secret_a"
+                assert environ.get("key_b") == "value of secret_b"
+            assert queries["get_secret"] == 0, queries
+
+            assert models.Secret._cache_ttls == {}, "Prefetching shouldn't turn on caching"
+            with environ.count_queries() as queries:
+                assert environ.get("key_a") == "value of secret_a"
+            assert queries["get_secret"] == 1, "Secrets that aren't cached are fetched after the first read"
+        finally:
+            anvil.secrets.get_secret = get_secret
+            models.Secret.disable_cache()
+        _mock.enable_environments()
+
+    def test_timeout(self):
+        _mock.use_backend(self._backend())
+        _mock.published()
+        get_secret, anvil.secrets.get_secret = anvil.secrets.get_secret, self._get_secret
+        try:
+            failures = environ.prefetch(["key_a", "key_b"], timeout=0.01)
+            assert {type(error) for error in failures.values()} == {TimeoutError}
+            assert set(failures) == {"key_a", "key_b"}
+        finally:
+            time.sleep(0.15)
+            anvil.secrets.get_secret = get_secret
+            models.Secret.disable_cache()
+        _mock.enable_environments()
+
+    def test_timeout_per_call(self):
+        _mock.use_backend(self._backend())
+        _mock.published()
+        get_secret, anvil.secrets.get_secret = anvil.secrets.get_secret, self._get_secret
+        try:
+            # One at a time the two fetches take longer than the timeout between them
+            failures = environ.prefetch(["key_a", "key_b"], max_workers=1, timeout=0.15)
+            assert failures == {}, failures
+        finally:
+            anvil.secrets.get_secret = get_secret
+            models.Secret.disable_cache()
+        _mock.enable_environments()
+
+
+class TestUsageProfile:
+    def test_prefetch(self):
+        backend = backends.MemoryBackend(
+            environments=["Published"],
+            rows=[{"key": "url", "value": "example.com"}, {"key": "port", "value": 8080}],
+        )
+        path = os.path.join(tempfile.mkdtemp(), "usage.json")
+        _mock.use_backend(backend)
+        _mock.published()
+        variables, src.VARIABLES = src.VARIABLES, models.Variables()
+        try:
+            environ.enable_usage_profile(path)
+            environ.get("url")
+            environ.get_many(["port", "missing"], defaults={"missing": None})
+            environ.save_usage_profile()
+
+            # The next start
+            src.VARIABLES = models.Variables()
+            _mock.use_backend(backend)
+            with environ.count_queries() as queries:
+                environ.enable_usage_profile(path)
+            assert queries["search"] == 1, f"The profile should be prefetched in one search {queries}"
+            assert {variable.name for variable in src.VARIABLES.in_use} == {"url", "port"}
+        finally:
+            src.VARIABLES.usage = None
+            src.VARIABLES = variables
+        _mock.enable_environments()
+
+
+class TestGetMany:
+    def test_mixed(self):
+        _mock.enable_environments()
+        _mock.published()
+
+        names = ["get_many_a_9f1e", "get_many_b_9f1e", "get_many_c_9f1e"]
+        with helpers.temp_writes():
+            environ.set(names[0], "PublishedValue", environments={"Published": True})
+            environ.set(names[0], "DefaultValue")
+            environ.set(names[1], "DefaultValue")
+
+            values = environ.get_many(names, defaults={names[2]: "CodeDefault"})
+            assert values == {
+                names[0]: "PublishedValue",
+                names[1]: "DefaultValue",
+                names[2]: "CodeDefault",
+            }, f"Unexpected values {values}"
+
+            _mock.staging()
+            values = environ.get_many(names[:2])
+            assert values == {names[0]: "DefaultValue", names[1]: "DefaultValue"}, f"Unexpected values {values}"
+
+            assert names[0] in environ.VARIABLES.in_use
+            assert names[2] in environ.VARIABLES.available
+
+    def test_missing(self):
+        _mock.disable_environments()
+        names = ["get_many_missing_a_5d20", "get_many_missing_b_5d20"]
+        with helpers.raises(LookupError):
+            environ.get_many(names)
+
+        try:
+            environ.get_many(names)
+        except LookupError as e:
+            for name in names:
+                assert name in str(e), f"Expected {name} in the error: {e}"
+
+    def test_overlapping_environments(self):
+        _mock.enable_environments()
+        _mock.debug()
+
+        variable_name = "get_many_overlapping_3b9c"
+        with helpers.temp_writes():
+            environ.set(variable_name, 1, environments={"Debug": True, "Published": True})
+            environ.set(variable_name, 2, environments={"Debug": True})
+            with helpers.raises(tables.TableError):
+                environ.get_many([variable_name])
+
 
 class TestSet:
     # We will use this to temporarily override the dev mode state
@@ -254,6 +590,62 @@ class TestSet:
             ), f"Did not get the expected value {var=} != {variable_value=}"
 
 
+class TestSetMany:
+    def test_mapping(self):
+        _mock.disable_environments()
+        names = ["set_many_a_0e4f", "set_many_b_0e4f"]
+        with helpers.temp_writes():
+            environ.set(names[0], "old")
+            environ.set_many({names[0]: 1, names[1]: 2})
+            assert environ.get_many(names) == {names[0]: 1, names[1]: 2}
+            assert len(src.DB.table.search(key=names[0])) == 1, "The existing row should be updated"
+
+    def test_environments(self):
+        _mock.enable_environments()
+        name = "set_many_environments_6a2c"
+        with helpers.temp_writes():
+            environ.set_many(
+                [
+                    (name, "DefaultValue"),
+                    (name, "PublishedValue", {"Published": True}, "published info"),
+                    (name, "DebugValue", ["Debug"]),
+                ],
+                info="shared info",
+            )
+            _mock.published()
+            assert environ.get(name) == "PublishedValue"
+            assert src.DB.table.get(key=name, Published=True)["info"] == "published info"
+            assert src.DB.table.get(key=name, Debug=True)["info"] == "shared info"
+
+            _mock.debug()
+            assert environ.get(name) == "DebugValue"
+
+            _mock.staging()
+            assert environ.get(name) == "DefaultValue"
+
+    def test_repeated_name(self):
+        _mock.enable_environments()
+        name = "set_many_repeated_91d0"
+        with helpers.temp_writes():
+            environ.set_many([(name, 1), (name, 2)])
+            assert len(src.DB.table.search(key=name)) == 1
+            assert environ.get(name) == 2
+
+    def test_overlapping_new_rows(self):
+        backend = backends.MemoryBackend(environments=["Debug", "Published"])
+        _mock.use_backend(backend)
+        environ.set_many([("url", "example.com", ["Debug", "Published"]), ("url", "debug.example.com", ["Debug"])])
+        assert len(backend.search(keys=["url"])) == 1, "The second item should update the pending row"
+        _mock.debug()
+        assert environ.get("url") == "debug.example.com"
+        _mock.enable_environments()
+
+    def test_not_implemented_error(self):
+        _mock.disable_environments()
+        with helpers.raises(NotImplementedError):
+            environ.set_many({"set_many_error_c3b1": 1}, environments={"Debug": True})
+
+
 class TestSecrets:
     def test_single_secret(self):
         _mock.disable_environments()
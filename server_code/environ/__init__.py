@@ -1,4 +1,5 @@
-from .src import get, set, DB, VARIABLES, ENVIRONMENT, info
+from .src import get, get_many, set, set_many, DB, VARIABLES, ENVIRONMENT, info, count_queries, snapshot, bump_version, export_snapshot, load_snapshot, resolve_all, prefetch, enable_usage_profile, save_usage_profile
+from .aio import aget, aget_many, aset
 from .models import Secret
 
-__all__ = ["get", "set", "DB", "VARIABLES", "ENVIRONMENT", "info", "Secret"]
+__all__ = ["get", "get_many", "set", "set_many", "DB", "VARIABLES", "ENVIRONMENT", "info", "count_queries", "snapshot", "bump_version", "export_snapshot", "load_snapshot", "resolve_all", "prefetch", "enable_usage_profile", "save_usage_profile", "aget", "aget_many", "aset", "Secret"]
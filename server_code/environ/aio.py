@@ -0,0 +1,130 @@
+from . import models, src
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable
+import asyncio
+import contextvars
+import functools
+import threading
+import weakref
+
+# Table and secret calls run here so they don't block the event loop
+MAX_WORKERS = 8
+_executor = None
+_executor_lock = threading.Lock()
+
+# Lookups in flight by event loop, concurrent awaits for the same lookup share one future
+_flights = weakref.WeakKeyDictionary()
+
+
+def configure(max_workers: int = MAX_WORKERS):
+    """Set how many table and secret calls can run at once, calls already running finish first
+    Args:
+        max_workers: size of the thread pool the awaitable API runs calls on
+    """
+    global _executor
+    with _executor_lock:
+        previous, _executor = _executor, ThreadPoolExecutor(max_workers, thread_name_prefix="environ")
+    if previous is not None:
+        previous.shutdown(wait=False)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix="environ")
+        return _executor
+
+
+async def _run(function: Callable, *args) -> Any:
+    """Run a blocking call on the executor in a copy of the current context"""
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(context.run, function, *args))
+
+
+async def _shared(key: tuple, function: Callable, *args) -> Any:
+    """Run a blocking call once for every coroutine awaiting the same key at the same time"""
+    flights = _flights.setdefault(asyncio.get_running_loop(), dict())
+    future = flights.get(key)
+    if future is None:
+        future = flights[key] = asyncio.ensure_future(_run(function, *args))
+        future.add_done_callback(lambda _: flights.pop(key, None))
+    # One awaiter being cancelled shouldn't cancel the lookup for the others
+    return await asyncio.shield(future)
+
+
+def _lookup(names: tuple[str, ...]) -> list[models.Variable]:
+    """Look up variables without defaults, each awaiter applies its own"""
+    variables = [models.Variable(name, models.NotSet) for name in names]
+    if not src.DB.is_ready:
+        src.logger.info(f"'env' not setup, returning default values for: {', '.join(names)}")
+        return variables
+    if len(variables) == 1:
+        return [src._get_value(variables[0], src.DB, src.ENVIRONMENT)]
+    return src._get_values(variables, src.DB, src.ENVIRONMENT)
+
+
+async def _read(found: models.Variable, default: Any) -> tuple[models.Variable, Any]:
+    """Apply the default and read the value, secrets are fetched on the executor"""
+    variable = models.Variable(found.name, default)
+    if found.in_use:
+        variable.value = found._value
+
+    src.VARIABLES._read(variable.name)
+    if isinstance(variable._value, models.Secret):
+        value = await _shared(("secret", variable._value.secret_name), src._read_value, variable)
+    else:
+        value = variable.value
+    return variable, value
+
+
+async def aget(name: str, default=models.NotSet) -> Any:
+    """Awaitable get, see environ.get
+    The lookup runs on a thread pool and coroutines getting the same variable at the same time
+    share it.  Uses the same caches as get.
+    """
+    (found,) = await _shared(("get", name), _lookup, (name,))
+    variable, value = await _read(found, default)
+    if value == models.NotSet:
+        raise LookupError(
+            f"env: {variable.name} not found in '{src.DB.name}' and no default value given."
+        )
+    src.VARIABLES._register(variable)
+    return value
+
+
+async def aget_many(names: Iterable[str], defaults: dict | None = None) -> dict:
+    """Awaitable get_many, see environ.get_many
+    The variables are looked up with a single search on a thread pool and secrets are fetched
+    concurrently.
+    """
+    defaults = defaults or dict()
+    names = tuple(dict.fromkeys(names))
+    found = await _shared(("get_many", names), _lookup, names)
+    results = await asyncio.gather(
+        *[_read(variable, defaults.get(variable.name, models.NotSet)) for variable in found]
+    )
+
+    values = dict()
+    missing = list()
+    for variable, value in results:
+        if value == models.NotSet:
+            missing.append(variable.name)
+        else:
+            values[variable.name] = value
+            src.VARIABLES._register(variable)
+
+    if missing:
+        raise LookupError(
+            f"env: {', '.join(missing)} not found in '{src.DB.name}' and no default value given."
+        )
+    return values
+
+
+async def aset(
+    name: str, value: Any, environments: dict | Iterable | None = None, info: str | None = None
+) -> None:
+    """Awaitable set, see environ.set"""
+    await _run(src.set, name, value, environments, info)
@@ -0,0 +1,455 @@
+from anvil import tables
+from anvil.tables import app_tables
+from anvil.tables import query as q
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Any, Iterable, Iterator
+import itertools
+import json
+import os
+import sqlite3
+import threading
+
+
+MULTIPLE_ROWS = "More than one row matched this query"
+
+
+def _matches(row, search: dict) -> bool:
+    return all(row[column] == value for column, value in search.items())
+
+
+class Backend:
+    """ Storage for the env table
+
+    Backends provide the few table operations environ needs so an EnvDB can resolve variables
+    from somewhere other than app_tables.  Rows returned by a backend must support
+    row[column], row.keys(), row.update(dict) and dict(row) like an anvil Row.
+    """
+    def __init__(self, name: str):
+        self.name = name
+
+    @property
+    def table(self) -> tables.Table | None:
+        """The app table behind the backend if there is one"""
+        return None
+
+    def exists(self) -> bool:
+        """Check if the table has been created"""
+        raise NotImplementedError
+
+    def list_columns(self) -> list[dict]:
+        """Column descriptions in the form of Table.list_columns()"""
+        raise NotImplementedError
+
+    def get(self, **search) -> Any:
+        """Look up the single row matching the search, same as Table.get
+
+        Raises:
+            tables.TableError when more than one row matches
+        """
+        raise NotImplementedError
+
+    def search(self, keys: Iterable[str] | None = None, any_of: list[dict] | None = None) -> list:
+        """Find rows in a single round trip
+        Args:
+            keys: only rows for these keys, None for every key
+            any_of: only rows that match at least one of these searches
+        """
+        raise NotImplementedError
+
+    def changed_since(self, column: str, since: datetime) -> list:
+        """Rows where the datetime column is at or after since, in a single round trip"""
+        return [row for row in self.search() if row[column] is not None and row[column] >= since]
+
+    def count(self) -> int:
+        """Number of rows in the table"""
+        return len(self.search())
+
+    def add_rows(self, rows: list[dict]) -> list:
+        """Add new rows in bulk"""
+        raise NotImplementedError
+
+    def update(self, row, values: dict):
+        """Write new values to a row from this backend"""
+        row.update(values)
+
+    def upsert(self, search: dict, values: dict) -> Any:
+        """Update the row matching the search, adding it first if it doesn't exist
+        Values for columns the row doesn't have are ignored.
+        """
+        row = self.get(**search) or self.add_rows([search])[0]
+        self.update(row, {k: v for k, v in values.items() if k in row.keys()})
+        return row
+
+    def transaction(self):
+        """Context manager grouping writes together"""
+        return nullcontext()
+
+    def __str__(self) -> str:
+        return f"{type(self).__name__}('{self.name}')"
+
+
+class AppTablesBackend(Backend):
+    """ The env table in anvil app_tables """
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._table = None
+
+    @property
+    def table(self) -> tables.Table | None:
+        """get the environment variable app table"""
+        if self._table is None:
+            if self.exists():
+                self._table = app_tables[self.name]
+        return self._table
+
+    def exists(self) -> bool:
+        return self.name in app_tables
+
+    def list_columns(self) -> list[dict]:
+        return self.table.list_columns()
+
+    def get(self, **search):
+        return self.table.get(**search)
+
+    def search(self, keys: Iterable[str] | None = None, any_of: list[dict] | None = None) -> list:
+        queries = list()
+        if any_of is not None:
+            queries.append(q.any_of(*[q.all_of(**search) for search in any_of]))
+        if keys is not None:
+            queries.append(q.all_of(key=q.any_of(*keys)))
+        return list(self.table.search(*queries))
+
+    def changed_since(self, column: str, since: datetime) -> list:
+        return list(self.table.search(**{column: q.greater_than_or_equal_to(since)}))
+
+    def count(self) -> int:
+        # The search iterator is lazy, len is answered by the server without loading rows
+        return len(self.table.search())
+
+    def add_rows(self, rows: list[dict]) -> list:
+        return self.table.add_rows(rows)
+
+    def transaction(self):
+        return tables.Transaction()
+
+
+class _MemoryRow(dict):
+    """ A row with an id like an anvil Row """
+    def __init__(self, row_id: int, values: dict):
+        super().__init__(values)
+        self._row_id = row_id
+
+    def get_id(self) -> int:
+        return self._row_id
+
+
+class MemoryBackend(Backend):
+    """ An env table held in a list of dicts
+
+    Useful for tests, CI and uplink workers that need config without a live server.
+    Rows are indexed by key so add rows with add_rows rather than editing `rows` directly.
+    """
+    def __init__(
+        self,
+        name: str = "env",
+        environments: Iterable[str] = (),
+        rows: Iterable[dict] = (),
+        columns: dict | None = None,
+    ):
+        """
+        Args:
+            name: name of the table
+            environments: names of the environment columns
+            rows: initial rows, missing columns are filled with None
+            columns: column types by name, defaults to key, value, info and the environments
+        """
+        super().__init__(name)
+        if columns is None:
+            columns = {"key": "string", "value": "simpleObject", "info": "string"}
+            columns.update({env: "bool" for env in environments})
+        self.columns = dict(columns)
+        self.rows = list()
+        self._by_key = dict()
+        self._ids = itertools.count(1)
+        self.add_rows(list(rows))
+
+    def exists(self) -> bool:
+        return True
+
+    def list_columns(self) -> list[dict]:
+        return [{"name": name, "type": type} for name, type in self.columns.items()]
+
+    def _candidates(self, keys: Iterable[str] | None) -> list[dict]:
+        """Rows for the keys from the index, every row when there are no keys"""
+        if keys is None:
+            return self.rows
+        return [row for key in dict.fromkeys(keys) for row in self._by_key.get(key, [])]
+
+    def get(self, **search):
+        keys = [search["key"]] if "key" in search else None
+        matching = [row for row in self._candidates(keys) if _matches(row, search)]
+        if len(matching) > 1:
+            raise tables.TableError(MULTIPLE_ROWS)
+        return matching[0] if matching else None
+
+    def search(self, keys: Iterable[str] | None = None, any_of: list[dict] | None = None) -> list:
+        if keys is None and any_of is not None and all("key" in search for search in any_of):
+            keys = [search["key"] for search in any_of]
+        return [
+            row for row in self._candidates(keys)
+            if any_of is None or any(_matches(row, search) for search in any_of)
+        ]
+
+    def count(self) -> int:
+        return len(self.rows)
+
+    def add_rows(self, rows: list[dict]) -> list:
+        new_rows = list()
+        for values in rows:
+            row = _MemoryRow(next(self._ids), {column: None for column in self.columns})
+            row.update(values)
+            new_rows.append(row)
+            self._by_key.setdefault(row["key"], []).append(row)
+        self.rows.extend(new_rows)
+        return new_rows
+
+
+class _SQLiteRow(dict):
+    """ A row that writes updates back to its SQLite table """
+    def __init__(self, backend: "SQLiteBackend", rowid: int, values: dict):
+        super().__init__(values)
+        self._backend = backend
+        self._rowid = rowid
+
+    def update(self, values: dict):
+        values = dict(values)
+        self._backend._update(self._rowid, values)
+        super().update(values)
+
+    def get_id(self) -> int:
+        return self._rowid
+
+
+class SQLiteBackend(Backend):
+    """ An env table in a local SQLite database
+
+    Values are stored as JSON so they must be simple objects, the same as a simpleObject column.
+    """
+    # JSON values are declared TEXT so SQLite doesn't give them numeric affinity
+    _TYPES = {"TEXT": "string", "JSON TEXT": "simpleObject", "BOOLEAN": "bool"}
+
+    def __init__(self, path: str = ":memory:", name: str = "env", environments: Iterable[str] = ()):
+        """
+        Args:
+            path: database file, the table is created if it doesn't exist
+            name: name of the table
+            environments: names of the environment columns to create with a new table
+        """
+        super().__init__(name)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._depth = 0
+
+        columns = ['"key" TEXT', '"value" JSON TEXT', '"info" TEXT']
+        columns += [f"{self._quote(env)} BOOLEAN" for env in environments]
+        with self._lock, self._connection:
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {self._quote(name)} ({', '.join(columns)})")
+
+    @staticmethod
+    def _quote(identifier: str) -> str:
+        return '"' + identifier.replace('"', '""') + '"'
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Commit when the outermost transaction exits or roll back on error"""
+        with self._lock:
+            self._depth += 1
+            try:
+                if self._depth > 1:
+                    yield
+                else:
+                    with self._connection:
+                        yield
+            finally:
+                self._depth -= 1
+
+    def _execute(self, sql: str, parameters: Iterable = ()) -> list:
+        with self._lock:
+            return self._connection.execute(sql, list(parameters)).fetchall()
+
+    def exists(self) -> bool:
+        return bool(self._execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", [self.name]))
+
+    def list_columns(self) -> list[dict]:
+        return [
+            {"name": name, "type": self._TYPES.get(type.upper(), "string")}
+            for _, name, type, *_ in self._execute(f"PRAGMA table_info({self._quote(self.name)})")
+        ]
+
+    def _decode(self, types: dict, record: tuple) -> _SQLiteRow:
+        rowid, *values = record
+        row = dict()
+        for column, value in zip(types, values):
+            if value is not None and types[column] == "simpleObject":
+                value = json.loads(value)
+            elif value is not None and types[column] == "bool":
+                value = bool(value)
+            row[column] = value
+        return _SQLiteRow(self, rowid, row)
+
+    def _encode(self, column: str, value: Any) -> Any:
+        if column == "value" and value is not None:
+            return json.dumps(value)
+        return value
+
+    def _where(self, search: dict) -> tuple[str, list]:
+        clauses = [f"{self._quote(column)} IS ?" for column in search]
+        parameters = [self._encode(column, value) for column, value in search.items()]
+        return " AND ".join(clauses) or "1", parameters
+
+    def _select(self, where: str, parameters: list) -> list[_SQLiteRow]:
+        types = {column["name"]: column["type"] for column in self.list_columns()}
+        selected = ", ".join(["rowid"] + [self._quote(column) for column in types])
+        records = self._execute(f"SELECT {selected} FROM {self._quote(self.name)} WHERE {where}", parameters)
+        return [self._decode(types, record) for record in records]
+
+    def get(self, **search):
+        rows = self._select(*self._where(search))
+        if len(rows) > 1:
+            raise tables.TableError(MULTIPLE_ROWS)
+        return rows[0] if rows else None
+
+    def search(self, keys: Iterable[str] | None = None, any_of: list[dict] | None = None) -> list:
+        clauses = list()
+        parameters = list()
+        if keys is not None:
+            keys = list(keys)
+            clauses.append(f'"key" IN ({", ".join("?" * len(keys))})')
+            parameters += keys
+        if any_of is not None:
+            searches = [self._where(search) for search in any_of]
+            clauses.append("(" + " OR ".join(f"({where})" for where, _ in searches) + ")")
+            for _, search_parameters in searches:
+                parameters += search_parameters
+        return self._select(" AND ".join(clauses) or "1", parameters)
+
+    def count(self) -> int:
+        return self._execute(f"SELECT COUNT(*) FROM {self._quote(self.name)}")[0][0]
+
+    def add_rows(self, rows: list[dict]) -> list:
+        new_rows = list()
+        with self.transaction():
+            for values in rows:
+                columns = ", ".join(self._quote(column) for column in values)
+                placeholders = ", ".join("?" * len(values))
+                cursor = self._connection.execute(
+                    f"INSERT INTO {self._quote(self.name)} ({columns}) VALUES ({placeholders})",
+                    [self._encode(column, value) for column, value in values.items()],
+                )
+                new_rows.append(cursor.lastrowid)
+        return [self._select("rowid IS ?", [rowid])[0] for rowid in new_rows]
+
+    def _update(self, rowid: int, values: dict):
+        if not values:
+            return
+        assignments = ", ".join(f"{self._quote(column)} = ?" for column in values)
+        with self.transaction():
+            self._connection.execute(
+                f"UPDATE {self._quote(self.name)} SET {assignments} WHERE rowid = ?",
+                [self._encode(column, value) for column, value in values.items()] + [rowid],
+            )
+
+
+class EnvironBackend(Backend):
+    """ Read-only overlay of os.environ on top of another backend
+
+    A variable found in os.environ replaces every row for that key in the base backend and
+    applies to all environments.  Values are decoded as JSON when possible so `PORT=8080`
+    gives the int 8080, anything else is returned as the string.  Writes go to the base backend.
+    """
+    def __init__(self, base: Backend | None = None, prefix: str = "", environ: dict | None = None):
+        """
+        Args:
+            base: backend to fall back to for variables that are not in os.environ
+            prefix: only os.environ variables with this prefix are used, ie. 'ENV_'
+            environ: mapping to read instead of os.environ
+        """
+        super().__init__(base.name if base is not None else "os.environ")
+        self.base = base
+        self.prefix = prefix
+        self.environ = os.environ if environ is None else environ
+        # Columns of the overlay rows, looked up once rather than for every variable in os.environ
+        self._columns = None
+
+    @property
+    def table(self) -> tables.Table | None:
+        return self.base.table if self.base is not None else None
+
+    def exists(self) -> bool:
+        return True
+
+    def list_columns(self) -> list[dict]:
+        if self.base is not None and self.base.exists():
+            return self.base.list_columns()
+        return [{"name": "key", "type": "string"}, {"name": "value", "type": "simpleObject"}]
+
+    def _row(self, key: str) -> dict | None:
+        """Build the overlay row for a key if it is set in os.environ"""
+        raw = self.environ.get(self.prefix + key)
+        if raw is None:
+            return None
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            value = raw
+        if self._columns is None:
+            self._columns = [column["name"] for column in self.list_columns()]
+        row = dict.fromkeys(self._columns)
+        row.update(key=key, value=value)
+        return row
+
+    def get(self, **search):
+        row = self._row(search["key"])
+        if row is None:
+            return self.base.get(**search) if self.base is not None else None
+        return row if _matches(row, search) else None
+
+    def search(self, keys: Iterable[str] | None = None, any_of: list[dict] | None = None) -> list:
+        keys = None if keys is None else list(keys)
+        base_rows = self.base.search(keys, any_of) if self.base is not None else list()
+
+        if keys is not None:
+            candidates = keys
+        elif any_of is not None:
+            candidates = [search["key"] for search in any_of if "key" in search]
+        else:
+            # Every key in the base table, plus os.environ variables when they are marked by a prefix
+            candidates = [row["key"] for row in base_rows]
+            if self.prefix:
+                candidates += [name[len(self.prefix):] for name in self.environ if name.startswith(self.prefix)]
+
+        overlay = dict()
+        for key in candidates:
+            row = self._row(key)
+            if row is not None:
+                overlay[key] = row
+
+        rows = [row for row in base_rows if row["key"] not in overlay]
+        rows += [row for row in overlay.values() if any_of is None or any(_matches(row, search) for search in any_of)]
+        return rows
+
+    def _writable(self) -> Backend:
+        if self.base is None:
+            raise NotImplementedError("os.environ is read-only, give a base backend to write to")
+        return self.base
+
+    def add_rows(self, rows: list[dict]) -> list:
+        return self._writable().add_rows(rows)
+
+    def upsert(self, search: dict, values: dict):
+        return self._writable().upsert(search, values)
+
+    def transaction(self):
+        return self._writable().transaction()
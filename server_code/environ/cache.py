@@ -0,0 +1,934 @@
+from anvil import tables
+
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Hashable, Iterable, Set
+import copy
+import hashlib
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import weakref
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on windows, shared snapshots need it for the leader lock
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class _Missing:
+    """ Marker for a variable that was looked up and not found """
+    def __str__(self):
+        return 'Missing'
+
+    def __repr__(self):
+        return 'Missing'
+
+MISSING = _Missing()
+
+# Version of the snapshot file layout written by dump_snapshot
+SNAPSHOT_FORMAT = 1
+
+
+class Encoded:
+    """ A JSON value from a snapshot file, only decoded when it is first read """
+    __slots__ = ("raw",)
+
+    def __init__(self, raw: str):
+        self.raw = raw
+
+    def decode(self) -> Any:
+        return json.loads(self.raw)
+
+
+def copy_value(value: Any) -> Any:
+    """A copy of a mutable value so callers changing it don't change what is cached"""
+    if isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+
+class Deferred:
+    """ Stands in for a large value in a snapshot row
+
+    Holds the value as compressed JSON, and the decoded value while the ValueCache has room for it.
+    """
+    __slots__ = ("name", "size", "raw", "value", "__weakref__")
+
+    def __init__(self, name: str, size: int, raw: bytes):
+        """
+        Args:
+            name: the variable the value belongs to
+            size: estimated bytes held by the decoded value
+            raw: the value as compressed JSON
+        """
+        self.name = name
+        self.size = size
+        self.raw = raw
+        self.value = MISSING
+
+    def decode(self) -> Any:
+        return json.loads(zlib.decompress(self.raw))
+
+    def encoded(self) -> Encoded:
+        return Encoded(zlib.decompress(self.raw).decode())
+
+    def __repr__(self):
+        return f"Deferred({self.name!r}, {self.size})"
+
+
+def sizeof(value: Any) -> int:
+    """Estimate the bytes held by a decoded value, counting the contents of containers"""
+    seen = set()
+    pending = [value]
+    size = 0
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            pending.extend(value.keys())
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            pending.extend(value)
+    return size
+
+
+class _StoredRow(dict):
+    """ A row read from a snapshot file with the id it had in the table """
+    def __init__(self, row_id: Any, values: dict):
+        super().__init__(values)
+        self._row_id = row_id
+
+    def get_id(self) -> Any:
+        return self._row_id
+
+
+class Snapshot:
+    """ In-memory copy of the env table
+
+    The whole table is loaded with a single search and indexed by (key, environment column).
+    Rows with every environment column set to None are the default for a key and are indexed
+    under (key, None).  `get` mirrors `Table.get` for the searches environ makes so a snapshot
+    can stand in for the table during lookups.
+
+    Rows are also kept by their row id so `patched` can apply changed rows without rebuilding the
+    index.  A snapshot is never changed once built, patching returns a new snapshot.
+
+    With a ValueCache large values are kept in the rows as compressed JSON and the cache holds the
+    decoded values up to its byte budget.  A value the cache has evicted is decoded again when read,
+    without going back to the table.
+    """
+    def __init__(
+        self,
+        rows: Iterable,
+        environments: Set[str],
+        ttl: float | None = None,
+        updated_column: str | None = None,
+        values: "ValueCache | None" = None,
+    ):
+        """
+        Args:
+            rows: rows from the env table, anything that can be converted with dict(row)
+            environments: names of the environment columns in the table
+            ttl: seconds before the snapshot is considered expired, None to never expire
+            updated_column: datetime column holding when each row was last written,
+                            the latest value is kept as `updated`
+            values: cache to keep large decoded values in, None to keep every value in the rows
+        """
+        self.environments = frozenset(environments)
+        self.ttl = ttl
+        self.updated_column = updated_column
+        self.updated = None
+        self.created = time.monotonic()
+        self.values = values
+
+        self._rows = dict()
+        self._index = dict()
+        self._ids = dict()
+        for row in rows:
+            self._add(row)
+
+    def _index_keys(self, key: str, row: dict) -> list[tuple]:
+        """The index entries for a row, each environment it is enabled for or (key, None)"""
+        if all(row.get(env) is None for env in self.environments):
+            return [(key, None)]
+        return [(key, env) for env in self.environments if row.get(env) is True]
+
+    def _add(self, row):
+        """Index a row by its key and each environment it is enabled for"""
+        row_id = row.get_id() if hasattr(row, "get_id") else None
+        row = dict(row)
+        if row_id is not None:
+            self._ids[row_id] = row
+
+        if self.updated_column is not None:
+            updated = row.get(self.updated_column)
+            if updated is not None and (self.updated is None or updated > self.updated):
+                self.updated = updated
+
+        key = row.get("key")
+        if key is None:
+            return
+
+        self._defer(key, row)
+        # New lists rather than appending, patched snapshots share the lists of unchanged keys
+        self._rows[key] = [*self._rows.get(key, ()), row]
+        for index_key in self._index_keys(key, row):
+            self._index[index_key] = [*self._index.get(index_key, ()), row]
+
+    def _remove(self, row_id: Hashable):
+        """Drop a row from the index by its row id"""
+        row = self._ids.pop(row_id, None)
+        key = row.get("key") if row is not None else None
+        if key is None:
+            return
+        if isinstance(row.get("value"), Deferred) and self.values is not None:
+            self.values.discard(row["value"])
+
+        for lookup, index_key in [(self._rows, key)] + [(self._index, k) for k in self._index_keys(key, row)]:
+            remaining = [other for other in lookup.get(index_key, ()) if other is not row]
+            if remaining:
+                lookup[index_key] = remaining
+            else:
+                lookup.pop(index_key, None)
+
+    def patched(self, rows: Iterable) -> "Snapshot | None":
+        """A new snapshot with the changed rows replacing the rows with the same ids
+        Args:
+            rows: rows added or modified since the snapshot was loaded
+
+        Returns:
+            the new snapshot, or None when a row doesn't have an id and the table has to be reloaded
+        """
+        snapshot = copy.copy(self)
+        snapshot._rows = dict(self._rows)
+        snapshot._index = dict(self._index)
+        snapshot._ids = dict(self._ids)
+        snapshot.created = time.monotonic()
+        for row in rows:
+            if not hasattr(row, "get_id"):
+                return None
+            snapshot._remove(row.get_id())
+            snapshot._add(row)
+        return snapshot
+
+    @property
+    def row_count(self) -> int:
+        """Number of rows that have an id"""
+        return len(self._ids)
+
+    @property
+    def age(self) -> float:
+        """Seconds since the snapshot was loaded"""
+        return time.monotonic() - self.created
+
+    @property
+    def expired(self) -> bool:
+        return self.ttl is not None and self.age > self.ttl
+
+    def renew(self):
+        """Start the ttl again for a snapshot that has been checked against the table"""
+        self.created = time.monotonic()
+
+    @property
+    def keys(self) -> Set[str]:
+        """All of the keys in the snapshot"""
+        return set(self._rows)
+
+    def _index_key(self, key: str, search: dict) -> tuple | None:
+        """Find the index entry that answers the search if there is one"""
+        if len(search) == 1:
+            ((column, value),) = search.items()
+            if value is True and column in self.environments:
+                return key, column
+        if set(search) == self.environments and all(value is None for value in search.values()):
+            return key, None
+        return None
+
+    def get(self, **search) -> dict | None:
+        """Find the single row matching the search
+
+        Raises:
+            tables.TableError when more than one row matches, same as `Table.get`
+        """
+        key = search.pop("key")
+        index_key = self._index_key(key, search)
+        if index_key is not None:
+            matching = self._index.get(index_key, [])
+        else:
+            # Anything that doesn't fit the index falls back to a scan of the rows for the key
+            matching = [
+                row for row in self._rows.get(key, [])
+                if all(row.get(column) == value for column, value in search.items())
+            ]
+
+        if len(matching) > 1:
+            raise tables.TableError("More than one row matched this query")
+        if not matching:
+            return None
+
+        return self._read(matching[0])
+
+    def _defer(self, key: str, row: dict, raw: str | None = None):
+        """Move a large value out of the row into the value cache
+        Args:
+            raw: the value as JSON when it came from a snapshot file
+        """
+        value = row.get("value")
+        if self.values is None or value is None or isinstance(value, (Encoded, Deferred)):
+            return
+        size = sizeof(value)
+        if size <= self.values.resident_size:
+            return
+        try:
+            # simpleObject values, the same JSON the table stores
+            raw = zlib.compress((raw if raw is not None else json.dumps(value)).encode())
+        except (TypeError, ValueError):
+            # Not JSON, keep it in the row
+            return
+        row["value"] = deferred = Deferred(key, size, raw)
+        self.values.put(deferred, value)
+
+    def _read(self, row: dict) -> dict:
+        """The row with its values decoded, a deferred value is taken from the cache or decoded again"""
+        for column, value in row.items():
+            if isinstance(value, Encoded):
+                row[column] = value.decode()
+                if column == "value":
+                    self._defer(row.get("key"), row, value.raw)
+
+        value = row.get("value")
+        if isinstance(value, Deferred):
+            deferred = value
+            value = self.values.get(deferred, MISSING)
+            if value is MISSING:
+                value = deferred.decode()
+                self.values.put(deferred, value)
+        elif not isinstance(value, (dict, list)):
+            return row
+        # A copy, the snapshot is shared by every thread and keeps its own value
+        return dict(row, value=copy_value(value))
+
+    def items(self) -> list[tuple]:
+        """Every row with its row id, None for rows without one"""
+        items = list(self._ids.items())
+        with_ids = {id(row) for _, row in items}
+        items += [(None, row) for rows in self._rows.values() for row in rows if id(row) not in with_ids]
+        # Large values as JSON text, writing a snapshot file doesn't need them decoded
+        return [
+            (row_id, dict(row, value=row["value"].encoded()) if isinstance(row.get("value"), Deferred) else row)
+            for row_id, row in items
+        ]
+
+
+def dump_snapshot(snapshot: Snapshot, path: str, columns: dict, **header):
+    """Write a snapshot to a file that load_snapshot can read
+
+    The file is a JSON header line followed by a JSON list of the rows.  simpleObject values are
+    kept as JSON text so loading doesn't decode values that are never read, and the header holds
+    a checksum of the rows.
+
+    Args:
+        snapshot: the snapshot to write
+        path: file to write
+        columns: column types by name, the table layout
+        header: anything else to keep in the header, ie. the table name and version marker
+    """
+    rows = list()
+    for row_id, row in snapshot.items():
+        stored = {"id": row_id}
+        for column, value in row.items():
+            if isinstance(value, Encoded):
+                value = value.raw
+            elif columns.get(column) == "simpleObject" and value is not None:
+                value = json.dumps(value)
+            elif isinstance(value, datetime):
+                value = value.isoformat()
+            stored[column] = value
+        rows.append(stored)
+
+    body = json.dumps(rows, separators=(",", ":")).encode()
+    header = dict(
+        header,
+        format=SNAPSHOT_FORMAT,
+        columns=columns,
+        checksum=hashlib.sha256(body).hexdigest(),
+    )
+    with open(path, "wb") as f:
+        f.write(json.dumps(header).encode() + b"\n")
+        f.write(body)
+
+
+def load_snapshot(path: str) -> tuple[dict, list[dict]]:
+    """Read a file written by dump_snapshot
+    Returns:
+        the header and the rows, values are decoded when they are first read from a Snapshot
+
+    Raises:
+        ValueError when the file is from another format version or doesn't match its checksum
+    """
+    with open(path, "rb") as f:
+        header = json.loads(f.readline())
+        body = f.read()
+
+    if header.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Snapshot '{path}' has format {header.get('format')}, expected {SNAPSHOT_FORMAT}")
+    if hashlib.sha256(body).hexdigest() != header.get("checksum"):
+        raise ValueError(f"Snapshot '{path}' doesn't match its checksum")
+
+    columns = header["columns"]
+    rows = list()
+    for stored in json.loads(body):
+        row_id = stored.pop("id")
+        for column, value in stored.items():
+            if value is None:
+                continue
+            if columns.get(column) == "simpleObject":
+                stored[column] = Encoded(value)
+            elif columns.get(column) == "datetime":
+                stored[column] = datetime.fromisoformat(value)
+        rows.append(_StoredRow(row_id, stored) if row_id is not None else stored)
+    return header, rows
+
+
+class SharedSnapshot:
+    """ A snapshot file shared by the processes on a host
+
+    The first process to take an exclusive lock on `<path>.lock` is the leader, it keeps the lock
+    until it exits and is the only process that loads the table and publishes snapshots to the
+    file.  `<path>.state` is memory mapped by every process and holds two counters: the generation,
+    moved by the leader after each publish, and the requests, moved by any process that writes
+    to the table so the leader knows to refresh.  Checking for a new snapshot is a read of the
+    mapped counters, no file is opened until one has been published.  Each counter is moved on
+    its own under a lock on the state file so concurrent moves aren't lost.
+    """
+    _STATE = struct.Struct("<QQ")
+    _COUNTER = struct.Struct("<Q")
+    _GENERATION = 0
+    _REQUESTS = _COUNTER.size
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: snapshot file, the lock and state files are created next to it
+        """
+        if fcntl is None:
+            raise NotImplementedError("Shared snapshots need file locks from fcntl, which this platform doesn't have")
+
+        self.path = path
+        self._lock_file = None
+        # Kept open to lock while moving a counter, the thread lock covers threads of this process
+        self._state_file = open(f"{path}.state", "a+b")
+        self._state_lock = threading.Lock()
+        if os.fstat(self._state_file.fileno()).st_size < self._STATE.size:
+            self._state_file.truncate(self._STATE.size)
+        self._state = mmap.mmap(self._state_file.fileno(), self._STATE.size)
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lock_file is not None
+
+    def try_lead(self) -> bool:
+        """Become the leader if no other process is, returns True if this process leads"""
+        if self._lock_file is None:
+            lock_file = open(f"{self.path}.lock", "a+b")
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        return True
+
+    def resign(self):
+        """Release the leader lock so another process can take over"""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    @property
+    def state(self) -> tuple[int, int]:
+        """The (generation, requests) counters"""
+        return self._STATE.unpack_from(self._state)
+
+    def _increment(self, offset: int) -> int:
+        """Add one to the counter at offset, returns the new value"""
+        with self._state_lock:
+            fcntl.flock(self._state_file.fileno(), fcntl.LOCK_EX)
+            try:
+                (value,) = self._COUNTER.unpack_from(self._state, offset)
+                self._COUNTER.pack_into(self._state, offset, value + 1)
+            finally:
+                fcntl.flock(self._state_file.fileno(), fcntl.LOCK_UN)
+        return value + 1
+
+    def request_refresh(self):
+        """Ask the leader to reload the table, ie. after writing to it"""
+        self._increment(self._REQUESTS)
+
+    def publish(self, snapshot: Snapshot, columns: dict, **header) -> int:
+        """Write a snapshot for the other processes, only the leader publishes
+        Returns:
+            the new generation
+        """
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        dump_snapshot(snapshot, temporary, columns, **header)
+        os.replace(temporary, self.path)
+        return self._increment(self._GENERATION)
+
+    def read(self) -> tuple[dict, list[dict]]:
+        """Read the published snapshot, see load_snapshot"""
+        return load_snapshot(self.path)
+
+    def close(self):
+        self.resign()
+        self._state.close()
+        self._state_file.close()
+
+
+class NegativeCache:
+    """ Remember variables that were not found in the table
+
+    Variables that fall back to their code default would otherwise search the table on every
+    get.  Misses are remembered per environment for `ttl` seconds, for at most `maxsize` names.
+    Expired names are dropped when making room, after that the least recently missed.
+    """
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._expires = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, environment: str | None):
+        """Record that the variable was not found for the environment"""
+        with self._lock:
+            self._expires.setdefault(name, dict())[environment] = time.monotonic() + self.ttl
+            self._expires.move_to_end(name)
+            if len(self._expires) > self.maxsize:
+                self._evict()
+
+    def _evict(self):
+        """Drop names whose misses have all expired, then the least recently missed until within maxsize"""
+        now = time.monotonic()
+        for name, entries in list(self._expires.items()):
+            if all(expires < now for expires in list(entries.values())):
+                self._expires.pop(name, None)
+        while len(self._expires) > self.maxsize:
+            self._expires.popitem(last=False)
+
+    def hit(self, name: str, environment: str | None) -> bool:
+        """Check if the variable is known to be missing for the environment"""
+        # Hold on to the entries, another thread can discard the name while we look
+        entries = self._expires.get(name, {})
+        expires = entries.get(environment)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            entries.pop(environment, None)
+            return False
+        return True
+
+    def discard(self, name: str):
+        """Forget any misses for the variable"""
+        self._expires.pop(name, None)
+
+    def clear(self):
+        self._expires.clear()
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+
+class TTLCache:
+    """ Size bounded cache where each entry expires after its own ttl
+
+    Expired entries are dropped when found and when making room, after that the least
+    recently used entry is evicted.  Safe to share between threads.
+    """
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._evict()
+
+    def _evict(self):
+        """Drop expired entries, then the least recently used until within maxsize"""
+        now = time.monotonic()
+        for key in [key for key, (expires, _) in self._entries.items() if expires < now]:
+            del self._entries[key]
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove an entry and return its value if it hasn't expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.monotonic():
+                return default
+            return entry[1]
+
+    def purge(self, key: Hashable | None = None):
+        """Remove an entry or everything when no key is given"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ValueCache:
+    """ LRU cache of large decoded variable values held to a budget of bytes
+
+    Snapshots keep values up to `resident_size` bytes in their rows and defer the larger ones,
+    so small settings are always in memory and large ones are only decoded while they are used.
+    Sizes are estimated from the decoded value with `sizeof`.  Least recently read values are
+    evicted once the budget is used up, except for pinned variables which stay until unpinned.
+    The compressed JSON of deferred values stays in the snapshot whatever the budget, it is
+    reported as raw_bytes in the stats rather than counted against max_bytes.
+    The cache only holds weak references to the deferred values, the values of a snapshot that is
+    no longer in use are dropped with it.  Safe to share between threads.
+    """
+    def __init__(self, max_bytes: int, resident_size: int = 512, pinned: Iterable[str] = ()):
+        """
+        Args:
+            max_bytes: budget for the decoded values held by the cache
+            resident_size: largest value in bytes kept in the snapshot rows rather than deferred
+            pinned: names of variables whose values are never evicted
+        """
+        self.max_bytes = max_bytes
+        self.resident_size = resident_size
+        self.pinned = set(pinned)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.raw_size = 0
+        # (weak reference, size) by id of the Deferred, least recently read first
+        self._entries = OrderedDict()
+        self._pinned = dict()
+        # (weak reference, compressed size) by id of every Deferred still in a snapshot
+        self._raw = dict()
+        # Deferred values that have been garbage collected, dropped on the next call
+        self._dead = list()
+        self._lock = threading.Lock()
+
+    def _reference(self, deferred: Deferred) -> weakref.ref:
+        # Only appends, the callback can run whenever the collector does
+        return weakref.ref(deferred, lambda ref, key=id(deferred): self._dead.append((key, ref)))
+
+    def _purge(self):
+        """Account for the deferred values that have been garbage collected"""
+        while self._dead:
+            key, ref = self._dead.pop()
+            for entries in (self._entries, self._pinned):
+                entry = entries.get(key)
+                if entry is not None and entry[0] is ref:
+                    del entries[key]
+                    self.size -= entry[1]
+            entry = self._raw.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._raw[key]
+                self.raw_size -= entry[1]
+
+    def get(self, deferred: Deferred, default: Any = None) -> Any:
+        with self._lock:
+            self._purge()
+            value = deferred.value
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            if id(deferred) in self._entries:
+                self._entries.move_to_end(id(deferred))
+            return value
+
+    def put(self, deferred: Deferred, value: Any):
+        with self._lock:
+            self._purge()
+            key = id(deferred)
+            if key not in self._raw:
+                self._raw[key] = (self._reference(deferred), len(deferred.raw))
+                self.raw_size += len(deferred.raw)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            elif key not in self._pinned:
+                entries = self._pinned if deferred.name in self.pinned else self._entries
+                entries[key] = (self._reference(deferred), deferred.size)
+                self.size += deferred.size
+            deferred.value = value
+            self._evict()
+
+    def _pop(self, key: int) -> Deferred | None:
+        """Stop holding a value, returns the Deferred if it is still alive"""
+        entry = self._entries.pop(key, None) or self._pinned.pop(key, None)
+        if entry is None:
+            return None
+        ref, size = entry
+        self.size -= size
+        deferred = ref()
+        if deferred is not None:
+            deferred.value = MISSING
+        return deferred
+
+    def _evict(self):
+        """Drop the least recently read values until within the budget"""
+        while self.size > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            size = self._entries[key][1]
+            if self._pop(key) is not None:
+                self.evictions += 1
+                self.evicted_bytes += size
+
+    def discard(self, deferred: Deferred):
+        """Drop a value that is no longer in use without counting it as an eviction"""
+        with self._lock:
+            self._purge()
+            self._pop(id(deferred))
+
+    def pin(self, name: str):
+        """Keep the values of the variable however long since they were read"""
+        with self._lock:
+            self._purge()
+            self.pinned.add(name)
+            for key in [key for key, (ref, _) in self._entries.items() if getattr(ref(), "name", None) == name]:
+                self._pinned[key] = self._entries.pop(key)
+
+    def unpin(self, name: str):
+        """Let the values of the variable be evicted again"""
+        with self._lock:
+            self._purge()
+            self.pinned.discard(name)
+            for key in [key for key, (ref, _) in self._pinned.items() if getattr(ref(), "name", None) == name]:
+                self._entries[key] = self._pinned.pop(key)
+            self._evict()
+
+    def clear(self):
+        """Drop every value, the stats are kept"""
+        with self._lock:
+            self._purge()
+            for key in list(self._entries) + list(self._pinned):
+                self._pop(key)
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            self._purge()
+            return {
+                "values": len(self._entries) + len(self._pinned),
+                "pinned": len(self._pinned),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+                "raw_bytes": self.raw_size,
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._purge()
+            return len(self._entries) + len(self._pinned)
+
+
+class _Call:
+    """ A call in flight and its outcome """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Coalesce concurrent calls for the same key into a single call
+
+    The first thread to ask for a key runs the function, threads asking for the same key while
+    it is in flight wait and share its result, or its exception.  Nothing is kept once the call
+    returns, the next call for the key runs the function again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key: Hashable, function: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def __len__(self) -> int:
+        """Number of calls in flight"""
+        return len(self._calls)
+
+
+class Refresher:
+    """ Call a function periodically on a daemon thread
+
+    Waits `interval` seconds between calls, give or take `jitter` as a fraction of the wait so
+    many processes don't hit the table together.  Each failure in a row doubles the wait up to
+    `max_backoff`, the next success goes back to the interval.
+    """
+    def __init__(
+        self,
+        function: Callable[[], Any],
+        interval: float,
+        jitter: float = 0.1,
+        max_backoff: float | None = None,
+        name: str = "environ-refresher",
+    ):
+        """
+        Args:
+            function: called on every refresh, exceptions are logged and count as a failure
+            interval: seconds between refreshes
+            jitter: fraction of the wait to randomly add or remove
+            max_backoff: longest wait after failures, defaults to 10 intervals
+        """
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff if max_backoff is not None else interval * 10
+        self.name = name
+
+        self.failures = 0
+        self.last_error = None
+        self.last_success = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        """Stop refreshing, waits up to timeout seconds for a refresh in progress"""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+
+    def delay(self) -> float:
+        """Seconds to wait before the next refresh"""
+        delay = self.interval
+        if self.failures:
+            delay = min(self.interval * 2 ** self.failures, self.max_backoff)
+        return max(0.0, delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def refresh(self) -> bool:
+        """Call the function once, returns False if it failed"""
+        try:
+            self.function()
+        except Exception as error:
+            self.failures += 1
+            self.last_error = error
+            logger.warning(f"{self.name}: refresh failed {self.failures} time(s) in a row: {error!r}")
+            return False
+
+        self.failures = 0
+        self.last_error = None
+        self.last_success = time.monotonic()
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.delay())
+
+
+class RequestSnapshot:
+    """ Read-consistent view of the env table for a `with environ.snapshot()` block
+
+    Each variable is resolved at most once and remembered for the rest of the block, along with
+    the environment column and the table snapshot used.  Outside of snapshot mode the table is
+    loaded with a single search on the first lookup in the block, so every variable is read from
+    the same view of the table.
+    """
+    def __init__(self, db):
+        """
+        Args:
+            db: the EnvDB the view is pinned to
+        """
+        self.db = db
+        self.values = dict()
+        self.environment_name = MISSING
+        self.table = None
+
+    def recall(self, variable) -> bool:
+        """Assign the remembered value to the variable, returns False if it hasn't been resolved yet"""
+        value = self.values.get(variable.name, None)
+        if value is None and variable.name not in self.values:
+            return False
+        if value is not MISSING:
+            variable.value = copy_value(value)
+        return True
+
+    def remember(self, variable):
+        """Keep the resolved value of the variable for the rest of the block"""
+        self.values[variable.name] = copy_value(variable._value) if variable.in_use else MISSING
+
+    def forget(self, name: str):
+        """Drop a variable that has been written so the next read resolves it again"""
+        self.values.pop(name, None)
+        self.table = None
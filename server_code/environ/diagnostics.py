@@ -0,0 +1,241 @@
+from . import backends
+
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterable, Iterator
+import bisect
+import contextvars
+import threading
+import time
+
+
+class QueryCounter:
+    """ Count the calls environ makes to the env table and App Secrets """
+    OPERATIONS = (
+        "exists", "list_columns", "get", "search", "changed_since", "count", "add_rows", "update", "upsert", "get_secret"
+    )
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.OPERATIONS, 0)
+        self._lock = threading.Lock()
+
+    def record(self, operation: str):
+        with self._lock:
+            self.counts[operation] += 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def __getitem__(self, operation: str) -> int:
+        return self.counts[operation]
+
+    def __str__(self):
+        counts = ", ".join(f"{operation}={count}" for operation, count in self.counts.items())
+        return f"Queries: total={self.total}, {counts}"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# Counters of the count_queries blocks open in the current context, calls made by other threads
+# and requests are not counted
+_active = contextvars.ContextVar("environ_query_counters", default=())
+_lock = threading.Lock()
+
+
+def record(operation: str):
+    """Add a call to every active counter, this is close to free when nothing is counting"""
+    for counter in _active.get():
+        counter.record(operation)
+
+
+class CountingBackend(backends.Backend):
+    """ Wrap a backend to record each call with the active counters
+
+    Shared by every count_queries block open on the backend, the last block to close unwraps it.
+    """
+    def __init__(self, base: backends.Backend):
+        super().__init__(base.name)
+        self.base = base
+        # count_queries blocks using the wrapper
+        self.users = 0
+
+    @property
+    def table(self):
+        return self.base.table
+
+    def exists(self) -> bool:
+        record("exists")
+        return self.base.exists()
+
+    def list_columns(self) -> list[dict]:
+        record("list_columns")
+        return self.base.list_columns()
+
+    def get(self, **search):
+        record("get")
+        return self.base.get(**search)
+
+    def search(self, keys: Iterable[str] | None = None, any_of: list[dict] | None = None) -> list:
+        record("search")
+        return self.base.search(keys, any_of)
+
+    def changed_since(self, column: str, since: datetime) -> list:
+        record("changed_since")
+        return self.base.changed_since(column, since)
+
+    def count(self) -> int:
+        record("count")
+        return self.base.count()
+
+    def add_rows(self, rows: list[dict]) -> list:
+        record("add_rows")
+        return self.base.add_rows(rows)
+
+    def update(self, row, values: dict):
+        record("update")
+        return self.base.update(row, values)
+
+    def upsert(self, search: dict, values: dict):
+        if type(self.base).upsert is not backends.Backend.upsert:
+            # The backend has its own upsert, count it as a single call
+            record("upsert")
+            return self.base.upsert(search, values)
+        # Run the generic upsert through the wrapper so its get, add_rows and update are counted
+        return super().upsert(search, values)
+
+    def transaction(self):
+        return self.base.transaction()
+
+
+@contextmanager
+def counting(db) -> Iterator[QueryCounter]:
+    """Count the calls made to the db backend and App Secrets inside the block
+    Args:
+        db: EnvDB whose backend is counted
+    """
+    counter = QueryCounter()
+    with _lock:
+        backend = db.backend
+        if not isinstance(backend, CountingBackend):
+            backend = db.backend = CountingBackend(backend)
+        backend.users += 1
+    _active.set(_active.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        # Blocks can close in any order, only take this counter out
+        _active.set(tuple(active for active in _active.get() if active is not counter))
+        with _lock:
+            backend.users -= 1
+            if backend.users == 0 and db.backend is backend:
+                db.backend = backend.base
+
+
+class Metrics:
+    """ Runtime instrumentation of variable lookups
+
+    Disabled by default, when disabled every record method returns straight away without
+    taking the lock.  Latency is tracked separately for table lookups and secret fetches.
+    """
+    # Upper bounds of the latency histogram buckets in seconds
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, float("inf"))
+    SOURCES = ("table", "secret")
+    CACHE_RESULTS = ("hit", "miss", "negative_hit")
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.reads = dict()
+            self.latency = {source: [0, 0.0, [0] * len(self.BUCKETS)] for source in self.SOURCES}
+            self.cache = dict.fromkeys(self.CACHE_RESULTS, 0)
+            self.overlap_errors = 0
+
+    def read(self, name: str):
+        """Count a read of the variable"""
+        if self.enabled:
+            with self._lock:
+                self.reads[name] = self.reads.get(name, 0) + 1
+
+    def start(self) -> float | None:
+        """Start timing a lookup, pass the result to observe()"""
+        return time.perf_counter() if self.enabled else None
+
+    def observe(self, source: str, start: float | None):
+        """Record the time since start() for a 'table' or 'secret' lookup"""
+        if start is None or not self.enabled:
+            return
+        elapsed = time.perf_counter() - start
+        bucket = bisect.bisect_left(self.BUCKETS, elapsed)
+        with self._lock:
+            stats = self.latency[source]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2][bucket] += 1
+
+    def cache_result(self, result: str, count: int = 1):
+        """Count a 'hit', 'miss' or 'negative_hit' of the caches"""
+        if self.enabled:
+            with self._lock:
+                self.cache[result] += count
+
+    def overlap_error(self):
+        if self.enabled:
+            with self._lock:
+                self.overlap_errors += 1
+
+    def _ratio(self, result: str) -> float | None:
+        total = sum(self.cache.values())
+        return self.cache[result] / total if total else None
+
+    def as_dict(self) -> dict:
+        """Export the metrics as plain python objects"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "reads": dict(self.reads),
+                "latency": {
+                    source: {
+                        "count": count,
+                        "total_s": total,
+                        "mean_s": total / count if count else None,
+                        "histogram": {f"<={bound}": n for bound, n in zip(self.BUCKETS, histogram)},
+                    }
+                    for source, (count, total, histogram) in self.latency.items()
+                },
+                "cache": dict(
+                    self.cache,
+                    hit_ratio=self._ratio("hit"),
+                    negative_hit_ratio=self._ratio("negative_hit"),
+                ),
+                "overlap_errors": self.overlap_errors,
+            }
+
+    def __str__(self):
+        if not self.enabled:
+            return "Metrics: disabled"
+        lines = ["Metrics"]
+        for source, (count, total, _) in self.latency.items():
+            mean = f"{total / count * 1000:.2f}ms" if count else "-"
+            lines.append(f"\t{source} lookups: {count}, total={total:.3f}s, mean={mean}")
+        cache = ", ".join(f"{result}={count}" for result, count in self.cache.items())
+        lines.append(f"\tcache: {cache}")
+        lines.append(f"\toverlap errors: {self.overlap_errors}")
+        busiest = sorted(self.reads.items(), key=lambda item: item[1], reverse=True)[:10]
+        reads = "\n\t\t".join(f"{name}: {count}" for name, count in busiest) or "No reads."
+        lines.append(f"\treads:\n\t\t{reads}")
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return self.__str__()
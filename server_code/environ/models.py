@@ -1,8 +1,16 @@
-from anvil.tables import app_tables
-from anvil import app
+from anvil import app, tables
 import anvil.secrets
 
-from typing import Set, Any
+from . import backends, cache, diagnostics
+
+from datetime import datetime, timedelta, timezone
+from collections.abc import Set as AbstractSet
+from types import MappingProxyType
+from typing import Set, Any, Iterable, NamedTuple
+import json
+import os
+import threading
+import time
 
 
 class LazyEnvironment:
@@ -12,63 +20,241 @@ class LazyEnvironment:
 
     def _cache(self):
         """ Get the environment state if missing"""
-        if self._environment is None:
-            self._environment = app.environment
+        environment = self._environment
+        if environment is None:
+            # Threads racing here all read the same app.environment
+            environment = self._environment = app.environment
+        return environment
 
     @property
     def name(self) -> str:
-        self._cache()
-        return self._environment.name
+        return self._cache().name
 
     @property
     def tags(self) -> str:
-        self._cache()
-        return self._environment.tags
+        return self._cache().tags
+
+
+class EnvironmentResolver:
+    """ Resolve an app environment name to one of the table environment columns
+
+    Built once from the table environments.  A column can only be a prefix of the name if the
+    name sliced to the column length is that column, so each lookup checks one slice per distinct
+    column length rather than calling startswith on every column.  Results, including ambiguous
+    matches, are memoized per environment name.
+    """
+    def __init__(self, environments: Set[str]):
+        self.environments = frozenset(environments)
+        self._lengths = sorted({len(env) for env in self.environments})
+        self._memo = dict()
+
+    def resolve(self, name: str) -> str | None:
+        """Find which of the table environments best match the given environment name
+        Raises:
+            LookupError when the name matches more than one environment
+        """
+        if name not in self._memo:
+            self._memo[name] = self._resolve(name)
+
+        result = self._memo[name]
+        if isinstance(result, LookupError):
+            raise LookupError(*result.args)
+        return result
+
+    def _resolve(self, name: str) -> str | LookupError | None:
+        if name in self.environments:
+            # Check for the direct match of environment name
+            return name
+
+        # Check for a generic environment ie 'Debug for abc@example.com' -> 'Debug'
+        matching = [name[:length] for length in self._lengths if name[:length] in self.environments]
+        if len(matching) == 1:
+            return matching[0]
+
+        elif len(matching) > 1:
+            return LookupError(
+                f"Environment: '{name}' matches more than one environment: {matching}"
+            )
+        return None
+
+
+# Reserved row holding a counter that is bumped on every write so caches can check for changes
+VERSION_KEY = "__environ_version__"
+VERSION_INFO = "Version marker maintained by environ, bump with environ.bump_version() after editing the table"
+
+# Attempts at moving the version marker when other writers conflict with the transaction
+VERSION_RETRIES = 5
+
+# Reserved row holding the usage profile when it is kept in the table, see UsageProfile
+USAGE_KEY = "__environ_usage__"
+USAGE_INFO = "Variable read counts maintained by environ for prefetching at startup"
+
+# Rows environ keeps for itself rather than variables
+RESERVED_KEYS = frozenset({VERSION_KEY, USAGE_KEY})
+
+# Optional datetime column that environ stamps on every write so refreshes only fetch changed rows
+UPDATED_COLUMN = "updated"
+
+# Stamps come from the clock of the process that wrote the row, a delta refresh fetches the rows
+# stamped this long before the latest one it has seen so clocks that are behind don't lose writes
+UPDATED_OVERLAP = timedelta(minutes=5)
+
+
+def now() -> datetime:
+    """Timestamp for the updated column"""
+    return datetime.now(timezone.utc)
+
+
+class Schema(NamedTuple):
+    """ Immutable snapshot of the env table layout, fetched with a single list_columns """
+    table_created: bool
+    columns: MappingProxyType
+    environments: frozenset
+    missing_columns: frozenset
+
+    @classmethod
+    def from_columns(cls, table_created: bool, columns: Iterable[dict], required_columns: Set[str]) -> "Schema":
+        """
+        Args:
+            table_created: if the table exists in app_tables
+            columns: column descriptions from Table.list_columns()
+            required_columns: names of the columns the table must have
+        """
+        columns = MappingProxyType({column["name"]: column["type"] for column in columns})
+        return cls(
+            table_created=table_created,
+            columns=columns,
+            # Extra bool columns are assumed to be environments
+            environments=frozenset(
+                name for name, type in columns.items() if name not in required_columns and type == "bool"
+            ),
+            missing_columns=frozenset(set(required_columns) - set(columns)),
+        )
+
+    @property
+    def is_ready(self) -> bool:
+        return self.table_created and not self.missing_columns
 
 
 class EnvDB:
-    def __init__(self, env_table_name: str):
+    def __init__(
+        self,
+        env_table_name: str,
+        backend: backends.Backend | None = None,
+        snapshot: bool = False,
+        snapshot_ttl: float | None = None,
+        negative_ttl: float | None = None,
+        version_marker: bool = False,
+    ):
+        """
+        Args:
+            env_table_name: name of the app table holding the environment variables
+            backend: where the table is stored, defaults to the app table named env_table_name
+            snapshot: answer lookups from an in-memory copy of the table loaded with one search
+            snapshot_ttl: seconds before the snapshot is reloaded, None to keep it until refresh()
+            negative_ttl: seconds to remember variables that were not found in the table,
+                          None to look them up every time
+            version_marker: bump the version marker row on every write and only reload an expired
+                            snapshot when the marker has moved
+        """
         self.name = env_table_name
         self.required_columns = {"key", "value"}
+        self.backend = backend if backend is not None else backends.AppTablesBackend(env_table_name)
 
         # Lazy load information on request to allow more flexibility in uplink
-        self._is_ready = None
-        self._table = None
-        self._environments = None
-        self._environments_enabled = None
+        self._schema = None
+        self._resolver = None
+
+        # Cached state is replaced rather than changed so readers don't need the lock,
+        # the lock and flights stop concurrent threads loading the same thing from the table
+        self._lock = threading.Lock()
+        self._flights = cache.SingleFlight()
+        self._generation = 0
+
+        self.snapshot_enabled = snapshot
+        self.snapshot_ttl = snapshot_ttl
+        self._snapshot = None
+        # The last snapshot before it was invalidated, the base for a delta refresh
+        self._previous = None
+
+        self.refresher = None
+        self.max_staleness = None
+        # snapshot_ttl from before the refresher took over, restored by stop_refresher
+        self._refresher_ttl = None
+        self.version_marker = version_marker
+
+        # Snapshot file shared with the other processes on the host, see share_snapshot
+        self.shared = None
+        self._shared_state = None
+        self._published = None
+
+        self.negative_cache = None
+        if negative_ttl is not None:
+            self.enable_negative_cache(negative_ttl)
+
+        # Large values held to a byte budget rather than in the snapshot rows, see enable_value_cache
+        self.value_cache = None
+
+    @property
+    def schema(self) -> Schema:
+        """Layout of the table, fetched once and shared until refresh_schema()"""
+        schema = self._schema
+        if schema is None:
+            schema = self._flights.do("schema", self._load_schema)
+        return schema
+
+    def _load_schema(self) -> Schema:
+        table_created = self._table_created()
+        columns = self.backend.list_columns() if table_created else list()
+        schema = self._schema = Schema.from_columns(table_created, columns, self.required_columns)
+        return schema
+
+    def refresh_schema(self):
+        """Fetch the table layout again to pick up new environment columns"""
+        self._schema = None
+        # Both are built from the environments
+        self._resolver = None
+        self.invalidate()
 
     @property
     def is_ready(self) -> bool:
         """Check that the table is setup and ready for use"""
-        if self._is_ready is None:
-            self._is_ready = self._table_created() and not self._missing_table_columns()
-        return self._is_ready
+        return self.schema.is_ready
 
     def _table_created(self) -> bool:
         """Check if the table has been created"""
-        return self.name in app_tables
+        return self.backend.exists()
 
     def _available_columns(self) -> Set[str]:
-        if self.table:
-            return {col["name"] for col in self.table.list_columns()}
-        else:
-            return set()
+        return set(self.schema.columns)
     
     def _missing_table_columns(self) -> Set[str]:
         """Check for missing columns in table"""
-        return self.required_columns - self._available_columns()
+        return set(self.schema.missing_columns)
 
     @property
     def environments(self) -> Set[str]:
         """ Extra bool columns are assumed to be environments """
-        if self._environments is None:
-            if self.table:
-                environments = set()
-                for column in self.table.list_columns():
-                    if column['name'] not in self.required_columns and column['type'] == 'bool':
-                        environments.add(column['name'])
-                self._environments = environments
-        return self._environments
+        return self.schema.environments
+
+    @property
+    def resolver(self) -> EnvironmentResolver:
+        """ Resolver for the table environments, built once and reused for every lookup """
+        resolver = self._resolver
+        if resolver is None:
+            resolver = self._resolver = EnvironmentResolver(self.environments)
+        return resolver
+
+    @property
+    def delta_enabled(self) -> bool:
+        """Check if the table has the updated column needed to refresh only the changed rows"""
+        return self.schema.columns.get(UPDATED_COLUMN) == "datetime"
+
+    def stamped(self, values: dict) -> dict:
+        """Add the updated time to the values written to a row when delta refresh is enabled"""
+        if self.delta_enabled:
+            return {**values, UPDATED_COLUMN: now()}
+        return values
 
     @property
     def environments_enabled(self) -> bool:
@@ -76,15 +262,391 @@ class EnvDB:
 
     @property
     def table(self):
-        """get the environment variable app table"""
-        if self._table is None:
-            if self._table_created():
-                self._table = app_tables[self.name]
-        return self._table
+        """get the environment variable app table, None when the backend is not app_tables"""
+        return self.backend.table
+
+    def enable_snapshot(self, ttl: float | None = None):
+        """Answer lookups from an in-memory copy of the table
+        Args:
+            ttl: seconds before the snapshot is reloaded, None to keep it until refresh()
+        """
+        self.snapshot_enabled = True
+        self.snapshot_ttl = ttl
+        self._snapshot = None
+
+    def disable_snapshot(self):
+        """Go back to querying the table on every lookup"""
+        self.stop_refresher()
+        self.stop_sharing()
+        self.snapshot_enabled = False
+        self._snapshot = None
+        self._previous = None
+
+    @property
+    def snapshot_stale(self) -> bool:
+        """Check if the next use of the snapshot will reload it from the table"""
+        return self._snapshot is None or self._snapshot.expired
+
+    @property
+    def snapshot(self) -> cache.Snapshot | None:
+        """In-memory copy of the table, reloaded once the ttl has passed"""
+        if not self.snapshot_enabled:
+            return None
+        snapshot = self._snapshot
+        if (
+            snapshot is None
+            or snapshot.expired
+            or self._too_stale(snapshot)
+            or (self.shared is not None and self.shared.state != self._shared_state)
+        ):
+            # Threads that find the snapshot stale together share a single reload
+            snapshot = self._flights.do("snapshot", self.revalidate)
+        return snapshot
+
+    def share_snapshot(self, path: str):
+        """Share one snapshot between the processes on a host through a file
+        One process leads, it loads the table and publishes each new snapshot to the file.  The
+        others only read the file when the leader has published, or the table itself when they
+        write to it, so the table is loaded once per host rather than once per process.  Another
+        process takes over when the leader exits.
+
+        Args:
+            path: snapshot file to share, every process must use the same path
+        """
+        self.stop_sharing()
+        if not self.snapshot_enabled:
+            self.enable_snapshot()
+        self.shared = cache.SharedSnapshot(path)
+
+    def stop_sharing(self):
+        if self.shared is not None:
+            self.shared.close()
+        self.shared = None
+        self._shared_state = None
+        self._published = None
+
+    def revalidate(self) -> cache.Snapshot | None:
+        """Bring the snapshot up to date, from the shared file when another process leads"""
+        if self.shared is None:
+            return self._revalidate_table()
+        if not self.shared.try_lead():
+            return self._follow()
+
+        generation, requests = self.shared.state
+        if self._shared_state is not None and requests != self._shared_state[1]:
+            # Another process wrote to the table
+            self.invalidate()
+        snapshot = self._revalidate_table()
+        if snapshot is not None and snapshot is not self._published:
+            generation = self.shared.publish(
+                snapshot, dict(self.schema.columns), table=self.name, version=self._version(snapshot)
+            )
+            self._published = snapshot
+        self._shared_state = (generation, requests)
+        return snapshot
+
+    def _follow(self) -> cache.Snapshot | None:
+        """Take the snapshot the leader published, or load the table when there isn't one to take"""
+        state = self.shared.state
+        generation = state[0]
+        seen = self._shared_state[0] if self._shared_state is not None else 0
+        if generation != seen:
+            header, rows = self.shared.read()
+            snapshot = self._from_file(header, rows)
+            with self._lock:
+                self._snapshot, self._previous = snapshot, None
+        elif self._snapshot is None:
+            # Nothing published yet, or this process wrote to the table and needs to see its writes
+            snapshot = self.refresh()
+        else:
+            snapshot = self._snapshot
+            snapshot.renew()
+        self._shared_state = state
+        return snapshot
+
+    def _revalidate_table(self) -> cache.Snapshot | None:
+        """Keep the snapshot when the version marker hasn't moved since it was loaded, otherwise reload it
+        Checking the marker is a single small query rather than a search of the whole table.
+        """
+        snapshot = self._snapshot
+        if self.version_marker and snapshot is not None:
+            version = self._version(snapshot)
+            if version is not None:
+                if version == self.version:
+                    snapshot.renew()
+                    return snapshot
+                # The marker also moves for hand edits, which have no updated stamp to patch from
+                return self.refresh()
+
+        base = snapshot if snapshot is not None else self._previous
+        if base is not None and self.delta_enabled:
+            patched = self._patch(base)
+            if patched is not None:
+                return patched
+        return self.refresh()
+
+    def _patch(self, snapshot: cache.Snapshot) -> cache.Snapshot | None:
+        """Apply the rows written since the snapshot was loaded, None when it needs a full reload
+        Rows are matched by row id.  Deleted rows can't be fetched, they show up as the table
+        having fewer rows than the patched snapshot and fall back to a full reload.  Rows stamped
+        up to UPDATED_OVERLAP before the snapshot's latest stamp are fetched again in case the
+        clock of the process that wrote them was behind.
+        """
+        if snapshot.updated is None or snapshot.environments != self.environments:
+            return None
+
+        generation = self._generation
+        changed = self.backend.changed_since(UPDATED_COLUMN, snapshot.updated - UPDATED_OVERLAP)
+        patched = snapshot.patched(changed)
+        if patched is None or patched.row_count != self.backend.count():
+            return None
+
+        patched.ttl = self.snapshot_ttl
+        if self.negative_cache is not None:
+            for row in changed:
+                self.negative_cache.discard(row["key"])
+        with self._lock:
+            if generation == self._generation:
+                self._snapshot = patched
+                self._previous = None
+        return patched
+
+    def _reserved_search(self, key: str) -> dict:
+        """Search for a reserved row, they are default rows"""
+        return {"key": key, **{env: None for env in self.environments}}
+
+    def _version(self, table: "backends.Backend | cache.Snapshot") -> int | None:
+        row = table.get(**self._reserved_search(VERSION_KEY))
+        return row["value"] if row is not None else None
+
+    @property
+    def version(self) -> int | None:
+        """Current value of the version marker in the table, None when it hasn't been created"""
+        return self._version(self.backend)
+
+    def bump_version(self) -> int:
+        """Move the version marker so caches watching it reload, creating the marker row if needed"""
+        search = self._reserved_search(VERSION_KEY)
+        for attempt in range(VERSION_RETRIES):
+            try:
+                with self.backend.transaction():
+                    version = (self._version(self.backend) or 0) + 1
+                    self.backend.upsert(search, self.stamped({"value": version, "info": VERSION_INFO}))
+                return version
+            except tables.TransactionConflict:
+                if attempt == VERSION_RETRIES - 1:
+                    raise
+                time.sleep(0.1 * 2**attempt)
+
+    def _too_stale(self, snapshot: cache.Snapshot | None) -> bool:
+        """Check if the snapshot is older than the refresher is allowed to serve"""
+        return self.max_staleness is not None and snapshot is not None and snapshot.age > self.max_staleness
+
+    def start_refresher(
+        self,
+        interval: float = 60.0,
+        jitter: float = 0.1,
+        max_backoff: float | None = None,
+        max_staleness: float | None = None,
+    ):
+        """Reload the snapshot on a background thread so lookups don't wait on the table once warm
+        When a reload fails the last good snapshot keeps being served until it is max_staleness old,
+        after that lookups reload the snapshot themselves and raise if the table is still unreachable.
+        With the version marker enabled a reload only checks the marker unless it has moved.
+
+        Args:
+            interval: seconds between reloads
+            jitter: fraction of the interval to randomly add or remove
+            max_backoff: longest wait between reloads after failures, defaults to 10 intervals
+            max_staleness: oldest snapshot in seconds to serve, None to serve the last good one forever
+        """
+        self.stop_refresher()
+        if not self.snapshot_enabled:
+            self.enable_snapshot()
+        # The refresher replaces the snapshot, lookups never wait for it to expire
+        self._refresher_ttl = self.snapshot_ttl
+        self.snapshot_ttl = None
+        self.max_staleness = max_staleness
+        self.refresher = cache.Refresher(
+            lambda: self._flights.do("snapshot", self.revalidate),
+            interval,
+            jitter=jitter,
+            max_backoff=max_backoff,
+            name=f"environ-refresher-{self.name}",
+        )
+        self.refresher.start()
+
+    def stop_refresher(self):
+        """Stop the background reloads, the snapshot is kept and expires after the ttl it had before"""
+        if self.refresher is None:
+            return
+        self.refresher.stop()
+        self.refresher = None
+        self.snapshot_ttl = self._refresher_ttl
+        snapshot = self._snapshot
+        if snapshot is not None:
+            snapshot.ttl = self.snapshot_ttl
+        self.max_staleness = None
+
+    @property
+    def snapshot_age(self) -> float | None:
+        """Seconds since the snapshot was loaded, None when there isn't one"""
+        snapshot = self._snapshot
+        return snapshot.age if snapshot is not None else None
+
+    @property
+    def healthy(self) -> bool:
+        """False when the background refresher is failing or the snapshot is past max_staleness"""
+        if self.refresher is None:
+            return True
+        return self.refresher.failures == 0 and not self._too_stale(self._snapshot)
+
+    def enable_negative_cache(self, ttl: float, maxsize: int = 1024):
+        """Remember variables that were not found in the table and use their default without a lookup
+        Args:
+            ttl: seconds before a missing variable is looked up again
+            maxsize: most missing variables to remember
+        """
+        self.negative_cache = cache.NegativeCache(ttl, maxsize)
+
+    def disable_negative_cache(self):
+        self.negative_cache = None
+
+    def enable_value_cache(self, max_bytes: int, resident_size: int = 512, pinned: Iterable[str] = ()):
+        """Hold the large values in the snapshot to a budget of bytes
+        Values up to resident_size bytes stay in the snapshot.  Larger ones are kept as compressed
+        JSON and their decoded values are held while there is room, the least recently read are
+        evicted and decoded again when next read.
+
+        Args:
+            max_bytes: budget for the large values
+            resident_size: largest value in bytes that is always kept in memory
+            pinned: names of variables whose values are never evicted
+        """
+        self.value_cache = cache.ValueCache(max_bytes, resident_size, pinned)
+        self.invalidate()
+
+    def disable_value_cache(self):
+        """Keep every value in the snapshot again"""
+        self.value_cache = None
+        self.invalidate()
+
+    def refresh(self) -> cache.Snapshot | None:
+        """Reload the snapshot from the table with a single search"""
+        if self.negative_cache is not None:
+            self.negative_cache.clear()
+        if not (self.snapshot_enabled and self.is_ready):
+            return None
+
+        generation = self._generation
+        snapshot = self._build_snapshot(self.backend.search())
+        with self._lock:
+            # Don't keep a snapshot that was loaded before a write invalidated it
+            if generation == self._generation:
+                self._snapshot = snapshot
+                self._previous = None
+        return snapshot
+
+    def _build_snapshot(self, rows: Iterable, bounded: bool = True) -> cache.Snapshot:
+        """
+        Args:
+            rows: rows from the table or a snapshot file
+            bounded: keep large values in the value cache when it is enabled
+        """
+        return cache.Snapshot(
+            rows,
+            self.environments,
+            ttl=self.snapshot_ttl,
+            updated_column=UPDATED_COLUMN if self.delta_enabled else None,
+            values=self.value_cache if bounded else None,
+        )
+
+    def export_snapshot(self, path: str):
+        """Write the table and its layout to a file to start other processes from with load_snapshot
+        Uses the current snapshot in snapshot mode, otherwise the table is loaded with a single search.
+        """
+        snapshot = self.snapshot if self.snapshot_enabled else None
+        if snapshot is None:
+            snapshot = self._build_snapshot(self.backend.search(), bounded=False)
+        cache.dump_snapshot(
+            snapshot, path, dict(self.schema.columns), table=self.name, version=self._version(snapshot)
+        )
+
+    def load_snapshot(self, path: str, verify: bool = True) -> bool:
+        """Start from a file written by export_snapshot rather than loading the table
+        The table layout comes from the file too, so a cold start makes no round trips.  When verify
+        is on the version marker in the file is checked against the table with one small query.  A
+        file that is out of date is only used as the base for a delta refresh on the next lookup.
+
+        Args:
+            path: file written by export_snapshot
+            verify: check the file against the table's version marker
+
+        Returns:
+            True if the snapshot is in use as is, False if it has to be refreshed first
+
+        Raises:
+            ValueError when the file is for another table, another format version or is corrupt
+        """
+        header, rows = cache.load_snapshot(path)
+        if header.get("table") != self.name:
+            raise ValueError(f"Snapshot '{path}' is for the '{header.get('table')}' table not '{self.name}'")
+
+        self.snapshot_enabled = True
+        snapshot = self._from_file(header, rows)
+
+        version = header.get("version")
+        current = not verify or (version is not None and version == self.version)
+        with self._lock:
+            self._generation += 1
+            if current:
+                self._snapshot, self._previous = snapshot, None
+            else:
+                self._snapshot, self._previous = None, snapshot
+        return current
+
+    def _from_file(self, header: dict, rows: list[dict]) -> cache.Snapshot:
+        """Build a snapshot from a snapshot file, taking the table layout from the file as well"""
+        columns = [{"name": name, "type": type} for name, type in header["columns"].items()]
+        schema = Schema.from_columns(True, columns, self.required_columns)
+        if schema != self._schema:
+            with self._lock:
+                self._schema = schema
+                self._resolver = None
+        return self._build_snapshot(rows)
+
+    def search(self, keys: Iterable[str] | None = None, any_of: list[dict] | None = None) -> list:
+        """Search the backend, threads making the same search at the same time share one query"""
+        flight = (
+            None if keys is None else tuple(sorted(keys)),
+            None if any_of is None else tuple(tuple(sorted(search.items())) for search in any_of),
+        )
+        return self._flights.do(("search", flight), self.backend.search, keys=keys, any_of=any_of)
+
+    def invalidate(self, name: str | None = None, reload: bool = False):
+        """Drop cached lookups so the next get goes back to the table
+        Args:
+            name: only forget that this variable was missing, None to forget every missing variable
+            reload: reload the whole snapshot rather than patching in the rows updated since it was loaded
+        """
+        with self._lock:
+            self._generation += 1
+            if reload:
+                self._previous = None
+            elif self._snapshot is not None:
+                self._previous = self._snapshot
+            self._snapshot = None
+        if self.shared is not None and not self.shared.is_leader:
+            self.shared.request_refresh()
+        if self.negative_cache is not None:
+            if name is None:
+                self.negative_cache.clear()
+            else:
+                self.negative_cache.discard(name)
 
     def __str__(self) -> str:
         info = f"ENV Table Status: {'Ready' if self.is_ready else 'Requires setup'}\n"
-        if self._table_created():
+        if self.schema.table_created:
             info += f"\t'{self.name}' table created\n"
         else:
             info += f"\t'{self.name}' table needs to be created\n"
@@ -94,6 +656,24 @@ class EnvDB:
             info += f"\t'{self.name}' missing columns: {', '.join(missing_columns)}"
         else:
             info += f"\t{', '.join(self.required_columns)} columns found"
+
+        if self.refresher is not None:
+            age = self.snapshot_age
+            info += (
+                f"\n\tRefresher: {'running' if self.refresher.running else 'stopped'} every {self.refresher.interval}s, "
+                f"{'healthy' if self.healthy else 'unhealthy'}, "
+                f"snapshot age {'-' if age is None else f'{age:.1f}s'}"
+            )
+            if self.refresher.last_error is not None:
+                info += f", {self.refresher.failures} failure(s), last error: {self.refresher.last_error!r}"
+
+        if self.value_cache is not None:
+            stats = self.value_cache.stats
+            info += (
+                f"\n\tValue cache: {stats['bytes']}/{stats['max_bytes']} bytes, {stats['values']} value(s), "
+                f"{stats['pinned']} pinned, {stats['hits']} hit(s), {stats['misses']} miss(es), "
+                f"{stats['evictions']} eviction(s), {stats['raw_bytes']} compressed bytes"
+            )
         return info
 
     def __repr__(self) -> str:
@@ -114,6 +694,13 @@ NotSet = _NotSet()
 class Secret(dict):
     """ We are inheriting from dict so we can use it's serialization in the env table. """
     SIGNATURE = '🔒'
+
+    # Secrets are fetched on every read unless caching has been enabled.
+    # Cache ttls are by secret name, the None entry applies to every secret.
+    _cache = cache.TTLCache()
+    _cache_ttls = dict()
+    # Threads missing the cache for the same secret share a single fetch
+    _flights = cache.SingleFlight()
     
     def __init__(self, secret_name: str):
         """ Create a pointer to a value in the Secrets store.
@@ -133,9 +720,74 @@ class Secret(dict):
         super().__setitem__(self.SIGNATURE, secret_name)
         
 
+    @classmethod
+    def _cache_ttl(cls, secret_name: str) -> float | None:
+        """Seconds to cache the secret, None when it isn't cached"""
+        return cls._cache_ttls.get(secret_name, cls._cache_ttls.get(None))
+
     def _get_secret(self) -> str:
+        ttl = self._cache_ttl(self.secret_name)
+        if ttl is None:
+            # A value fetched ahead by _warm serves the first read, every later read fetches
+            value = self._cache.pop(self.secret_name, NotSet)
+            return self._fetch() if value is NotSet else value
+
+        value = self._cache.get(self.secret_name, NotSet)
+        if value is NotSet:
+            value = self._flights.do(self.secret_name, self._fetch_and_cache, ttl)
+        return value
+
+    def _fetch_and_cache(self, ttl: float) -> str:
+        value = self._fetch()
+        self._cache.set(self.secret_name, value, ttl)
+        return value
+
+    def _warm(self, ttl: float):
+        """Fetch the secret ahead of its next read without changing how it is cached
+        Args:
+            ttl: seconds to keep the value for a secret that isn't cached, it is used for one read
+        """
+        cache_ttl = self._cache_ttl(self.secret_name)
+        self._flights.do(self.secret_name, self._fetch_and_cache, ttl if cache_ttl is None else cache_ttl)
+
+    def _fetch(self) -> str:
+        """Get the secret value from App Secrets"""
+        diagnostics.record("get_secret")
         return anvil.secrets.get_secret(self.secret_name)
 
+    @classmethod
+    def enable_cache(cls, ttl: float, secret_name: str | None = None, maxsize: int | None = None):
+        """ Keep secret values in memory rather than fetching them on every read
+        Args:
+            ttl: seconds to keep a secret value before fetching it again
+            secret_name: only cache this secret, None to cache every secret
+            maxsize: most secret values to hold at once
+        """
+        cls._cache_ttls[secret_name] = ttl
+        if maxsize is not None:
+            cls._cache.maxsize = maxsize
+
+    @classmethod
+    def disable_cache(cls, secret_name: str | None = None):
+        """ Go back to fetching secrets on every read
+        Args:
+            secret_name: stop caching this secret, None to stop caching every secret
+        """
+        if secret_name is None:
+            cls._cache_ttls.clear()
+        else:
+            # A None ttl overrides any cache enabled for every secret
+            cls._cache_ttls[secret_name] = None
+        cls.purge_cache(secret_name)
+
+    @classmethod
+    def purge_cache(cls, secret_name: str | None = None):
+        """ Remove cached secret values
+        Args:
+            secret_name: remove this secret, None to remove every secret
+        """
+        cls._cache.purge(secret_name)
+
     def __str__(self):
         return f"{self.SIGNATURE}{self.secret_name}"
     
@@ -151,6 +803,8 @@ class Secret(dict):
         
 
 class Variable:
+    __slots__ = ("name", "default", "_value", "in_use")
+
     def __init__(self, name: str, default: Any):
         self.name = name
         self.default = default
@@ -183,7 +837,12 @@ class Variable:
         return hash(self.name)
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        # Compare by name so a name string finds its variable in the registry views
+        if isinstance(other, Variable):
+            return self.name == other.name
+        if isinstance(other, str):
+            return self.name == other
+        return NotImplemented
 
     def __str__(self):
         return str(self.name)
@@ -194,9 +853,122 @@ class Variable:
         return f"{self.name}={self._value}, default={self.default}, in_use={self.in_use}"
 
 
+class UsageProfile:
+    """ Which variables a process reads and how often, kept between runs
+
+    Read counts are stored as JSON in a local file, or in a reserved row of the env table when
+    no path is given.  Saving adds this run's counts to the stored ones so the profile covers
+    every run and every process sharing it.
+    """
+    def __init__(self, db: EnvDB, path: str | None = None):
+        """
+        Args:
+            db: EnvDB to keep the profile in when there is no path
+            path: JSON file to keep the profile in
+        """
+        self.db = db
+        self.path = path
+        self.reads = dict()
+        self._lock = threading.Lock()
+
+    def record(self, name: str):
+        """Count a read of the variable"""
+        with self._lock:
+            self.reads[name] = self.reads.get(name, 0) + 1
+
+    def load(self) -> dict:
+        """The stored read counts by variable name"""
+        if self.path is not None:
+            try:
+                with open(self.path) as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                return dict()
+
+        if not self.db.is_ready:
+            return dict()
+        row = self.db.backend.get(**self.db._reserved_search(USAGE_KEY))
+        return dict(row["value"]) if row is not None and row["value"] else dict()
+
+    def names(self, limit: int | None = None) -> list[str]:
+        """Stored variable names, most read first
+        Args:
+            limit: most names to return, None for all of them
+        """
+        counts = self.load()
+        names = sorted(counts, key=lambda name: counts[name], reverse=True)
+        return names[:limit] if limit is not None else names
+
+    def save(self):
+        """Add the reads from this run to the stored profile"""
+        with self._lock:
+            reads, self.reads = self.reads, dict()
+        if not reads:
+            return
+
+        if self.path is not None:
+            counts = self.load()
+            for name, count in reads.items():
+                counts[name] = counts.get(name, 0) + count
+            temporary = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary, "w") as f:
+                json.dump(counts, f)
+            os.replace(temporary, self.path)
+            return
+
+        if not self.db.is_ready:
+            return
+        with self.db.backend.transaction():
+            counts = self.load()
+            for name, count in reads.items():
+                counts[name] = counts.get(name, 0) + count
+            self.db.backend.upsert(
+                self.db._reserved_search(USAGE_KEY), self.db.stamped({"value": counts, "info": USAGE_INFO})
+            )
+
+
+class VariablesView(AbstractSet):
+    """ Read only set of registered variables, backed by the registry so it never goes stale
+
+    Membership and len are O(1) and accept a Variable or its name.  Iterating copies the
+    variables first so registering while iterating is safe.
+    """
+    __slots__ = ("_variables",)
+
+    def __init__(self, variables: dict):
+        self._variables = variables
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        # Set operations return a plain set
+        return set(iterable)
+
+    def __contains__(self, variable) -> bool:
+        try:
+            return variable in self._variables
+        except TypeError:
+            return False
+
+    def __iter__(self):
+        return iter(list(self._variables.values()))
+
+    def __len__(self) -> int:
+        return len(self._variables)
+
+    def __repr__(self) -> str:
+        return f"{{{', '.join(repr(str(variable)) for variable in self)}}}"
+
+
 class Variables:
     def __init__(self):
+        # Variables by name, in_use and available are kept up to date as variables register
         self._all = dict()
+        self._in_use = dict()
+        self._available = dict()
+        self._views = (VariablesView(self._all), VariablesView(self._in_use), VariablesView(self._available))
+        self._lock = threading.Lock()
+        self.metrics = diagnostics.Metrics()
+        self.usage = None
 
     def __str__(self):
         in_use = "\n\t\t".join([str(variable) for variable in self.in_use]) or "No variables in use."
@@ -212,23 +984,37 @@ class Variables:
     def __repr__(self):
         return self.__str__()
 
+    def _read(self, name: str):
+        """Count a read of the variable for the metrics and usage profile"""
+        self.metrics.read(name)
+        if self.usage is not None:
+            self.usage.record(name)
+
     def _register(self, variable: Variable):
         """Add variable as currently in use from db"""
-        self._all[variable.name] = variable
+        name = variable.name
+        with self._lock:
+            self._all[name] = variable
+            if variable.in_use:
+                self._in_use[name] = variable
+                self._available.pop(name, None)
+            else:
+                self._available[name] = variable
+                self._in_use.pop(name, None)
     
     @property
-    def all(self):
-        """Get a set of all registered variable names"""
-        return set(self._all.values())
+    def all(self) -> VariablesView:
+        """Get a view of all registered variables"""
+        return self._views[0]
 
     @property
-    def in_use(self):
-        """Get a set of variable names that are being set from the env table"""
-        return set(filter(lambda var: var.in_use, self.all))
+    def in_use(self) -> VariablesView:
+        """Get a view of the variables that are being set from the env table"""
+        return self._views[1]
 
     @property
-    def available(self):
-        """Get a set of varible names that are utilizing their default value
+    def available(self) -> VariablesView:
+        """Get a view of the variables that are utilizing their default value
         and not present in the env table.
         """
-        return set(filter(lambda var: not var.in_use, self.all))
+        return self._views[2]
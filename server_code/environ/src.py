@@ -1,11 +1,17 @@
 from anvil import tables
-from anvil.tables import Row, Table
+from anvil.tables import Row
 from anvil import app
 
-from . import models
+from . import backends, models, cache, diagnostics
 
-from typing import Any, Set, Iterable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Set, Iterable, Iterator
+import atexit
+import contextvars
 import logging
+import math
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +24,9 @@ VARIABLES = models.Variables()
 # Check if we are in the published or development mode
 ENVIRONMENT = models.LazyEnvironment()
 
+# The request snapshot open in the current context, see snapshot()
+_REQUEST_SNAPSHOT = contextvars.ContextVar("environ_request_snapshot", default=None)
+
 
 def info():
     """Display info about ENV"""
@@ -28,35 +37,70 @@ def info():
         f"Table name: {DB.name}",
         f"Table ready: {DB.is_ready}"
     ]
+    if DB.refresher is not None:
+        age = DB.snapshot_age
+        s.append(f"Table healthy: {DB.healthy}, snapshot age: {'-' if age is None else f'{age:.1f}s'}")
     if not DB.is_ready:
-        s.append(f"  Table '{DB.name}' created: {DB._table_created()}")
+        s.append(f"  Table '{DB.name}' created: {DB.schema.table_created}")
         s.append(f"  Missing columns: {DB._missing_table_columns()}")
     s.append(f"\n{VARIABLES}")
+    if VARIABLES.metrics.enabled:
+        s.append(f"\n{VARIABLES.metrics}")
     print("\n".join(s))
 
 
+@contextmanager
+def count_queries(db: models.EnvDB | None = None) -> Iterator[diagnostics.QueryCounter]:
+    """Count the env table and App Secrets calls made inside the block
+    Args:
+        db: EnvDB to count, defaults to DB
+
+    Example:
+        with environ.count_queries() as queries:
+            environ.get('APP_URL')
+        assert queries['search'] <= 1, queries
+    """
+    with diagnostics.counting(db if db is not None else DB) as counter:
+        yield counter
+
+
+@contextmanager
+def snapshot() -> Iterator[cache.RequestSnapshot]:
+    """Pin a read-consistent view of the env table for the duration of the block
+    Every get inside the block, including calls made by other functions, resolves each variable
+    at most once and then reuses the result.  Nested blocks share the outer view.
+
+    Example:
+        @anvil.server.callable
+        def handler():
+            with environ.snapshot():
+                ...
+    """
+    current = _pinned(DB)
+    if current is not None:
+        yield current
+        return
+
+    token = _REQUEST_SNAPSHOT.set(cache.RequestSnapshot(DB))
+    try:
+        yield _REQUEST_SNAPSHOT.get()
+    finally:
+        _REQUEST_SNAPSHOT.reset(token)
+
+
+def _pinned(db: models.EnvDB) -> cache.RequestSnapshot | None:
+    """The open request snapshot for the db if there is one"""
+    pinned = _REQUEST_SNAPSHOT.get()
+    if pinned is not None and pinned.db is db:
+        return pinned
+    return None
+
+
 def resolve_environment(
     current_environment: str, available_environments: Set[str]
 ) -> str | None:
     """Find which of the available table environments best match the given environment"""
-    if current_environment in available_environments:
-        # Check for the direct match of environment name
-        return current_environment
-    else:
-        # Check for a generic environment ie 'Debug for abc@example.com' -> 'Debug'
-        matching = list(
-            filter(
-                lambda env: current_environment.startswith(env), available_environments
-            )
-        )
-        if len(matching) == 1:
-            return matching[0]
-
-        elif len(matching) > 1:
-            raise LookupError(
-                f"Environment: '{current_environment}' matches more than one environment: {matching}"
-            )
-    return None
+    return models.EnvironmentResolver(available_environments).resolve(current_environment)
 
 
 def _normalize_environment_request(environments: dict | Iterable | str | None, availble_envrionments: Set) -> dict:
@@ -141,30 +185,251 @@ def set(
         env_request = _normalize_environment_request(environments, DB.environments)
         search.update(**env_request)
 
-        # find or create the row
-        row = DB.table.get(**search) or DB.table.add_row(**search)
-
-        # Add the variable information
-        update = {"value": value, "info": info}
-        row.update({k: v for k, v in update.items() if k in row.keys()})
+        # find or create the row and add the variable information
+        DB.backend.upsert(search, DB.stamped({"value": value, "info": info}))
+        _written([name])
     else:
         raise tables.TableError(f"'{DB.name}' table not set up.")
 
 
-def _try_lookup(search: dict, table: Table) -> Row | None:
+def _set_items(
+    variables: dict | Iterable[tuple], environments: dict | Iterable | str | None, info: str | None
+) -> list[tuple]:
+    """Normalize the set_many request into (name, value, environments, info) tuples"""
+    if isinstance(variables, dict):
+        return [(name, value, environments, info) for name, value in variables.items()]
+
+    items = list()
+    for item in variables:
+        name, value, *extra = item
+        if len(extra) > 2:
+            raise TypeError(f"Expected (name, value, environments, info) received: {item}")
+        # Fill the optional fields from the shared arguments
+        item_environments, item_info = extra + [environments, info][len(extra):]
+        items.append((name, value, item_environments, item_info))
+    return items
+
+
+def set_many(
+    variables: dict | Iterable[tuple],
+    environments: dict | Iterable | str | None = None,
+    info: str | None = None,
+) -> None:
+    """Set several environment variables in a single transaction
+    The existing rows are fetched with one search and any missing rows are added together.
+
+    Args:
+        variables: dict of values by variable name or an iterable of
+                    (name, value), (name, value, environments) or (name, value, environments, info)
+        environments: environments for variables that don't give their own, see `set`
+        info: human-readable information for variables that don't give their own
+    """
+    items = _set_items(variables, environments, info)
+    if not items:
+        return
+
+    if any(item_environments for _, _, item_environments, _ in items) and not DB.environments_enabled:
+        raise NotImplementedError(
+            f"Environments have not been enabled in the '{DB.name}' table.  "
+            "Add bool columns for each environment ie. 'Published', 'Debug'"
+        )
+
+    if not DB.is_ready:
+        raise tables.TableError(f"'{DB.name}' table not set up.")
+
+    available_environments = DB.environments
+    columns = DB.schema.columns
+    with DB.backend.transaction():
+        rows = dict()
+        for row in DB.backend.search(keys={name for name, *_ in items}):
+            rows.setdefault(row["key"], []).append(row)
+
+        # rows to add by key, later requests that match them update the same new row
+        new_rows = dict()
+        for name, value, item_environments, item_info in items:
+            search = {"key": name}
+            search.update(_normalize_environment_request(item_environments, available_environments))
+            update = {k: v for k, v in DB.stamped({"value": value, "info": item_info}).items() if k in columns}
+
+            row = _select_row(rows.get(name, []), search)
+            if row is not None:
+                DB.backend.update(row, update)
+                continue
+
+            pending = new_rows.setdefault(name, [])
+            row = _select_row(pending, search)
+            if row is not None:
+                row.update(update)
+            else:
+                pending.append({**{env: None for env in available_environments}, **search, **update})
+
+        if new_rows:
+            DB.backend.add_rows([row for pending in new_rows.values() for row in pending])
+
+    _written([name for name, *_ in items])
+
+
+def export_snapshot(path: str):
+    """Write the env table and its layout to a file for load_snapshot
+    Args:
+        path: file to write
+    """
+    if not DB.is_ready:
+        raise tables.TableError(f"'{DB.name}' table not set up.")
+    DB.export_snapshot(path)
+
+
+def load_snapshot(path: str, verify: bool = True) -> bool:
+    """Answer lookups from a file written by export_snapshot, turning on snapshot mode
+    Values are only decoded when they are read so startup is a single file read.
+    Args:
+        path: file written by export_snapshot
+        verify: check the file against the table's version marker, a file that is out of date
+                is refreshed on the next lookup
+
+    Returns:
+        True if the file is current and in use as is
+    """
+    return DB.load_snapshot(path, verify=verify)
+
+
+def bump_version() -> int:
+    """Mark the env table as changed so caches watching the version marker reload
+    Call this after editing the table directly, environ.set does it for you when the
+    version marker is enabled.
+
+    Returns:
+        the new version
+    """
+    if not DB.is_ready:
+        raise tables.TableError(f"'{DB.name}' table not set up.")
+    version = DB.bump_version()
+    DB.invalidate(reload=True)
+    return version
+
+
+def _written(names: Iterable[str]):
+    """Drop the cached lookups of variables that have been written and move the version marker"""
+    pinned = _pinned(DB)
+    for name in names:
+        DB.invalidate(name)
+        if pinned is not None:
+            pinned.forget(name)
+    if DB.version_marker:
+        try:
+            DB.bump_version()
+        except tables.TransactionConflict as e:
+            # The values are written, other processes pick them up when their snapshots expire
+            logger.warning(f"env: unable to move the version marker: {e!r}")
+
+
+def _overlap_error(search: dict) -> tables.TableError:
+    VARIABLES.metrics.overlap_error()
+    return tables.TableError(
+        f"Do you have two entries for '{search}', ensure there are no overlapping environments for the variable."
+    )
+
+
+def _try_lookup(search: dict, table: backends.Backend | cache.Snapshot) -> Row | dict | None:
     """Search for a row and give feedback on multiple matches"""
     try:
         row = table.get(**search)
     except tables.TableError as e:
         if e.message == "More than one row matched this query":
-            raise tables.TableError(
-                f"Do you have two entries for '{search}', ensure there are no overlapping environments for the variable."
-            ) from e
+            raise _overlap_error(search) from e
         else:
             raise e
     return row
 
 
+def _select_row(rows: Iterable[Row | dict], search: dict) -> Row | dict | None:
+    """Pick the row matching the search from rows that have already been fetched.
+    This is the client side equivalent of _try_lookup.
+    """
+    matching = [
+        row for row in rows if all(row[column] == value for column, value in search.items())
+    ]
+    if len(matching) > 1:
+        raise _overlap_error(search)
+    return matching[0] if matching else None
+
+
+def _environment_name(db: models.EnvDB, environment: models.LazyEnvironment) -> str | None:
+    """Find the table environment column for the current environment"""
+    pinned = _pinned(db)
+    if pinned is not None and pinned.environment_name is not cache.MISSING:
+        return pinned.environment_name
+
+    environment_name = None
+    if db.environments_enabled and environment is not None:
+        environment_name = db.resolver.resolve(environment.name)
+
+    if pinned is not None:
+        pinned.environment_name = environment_name
+    return environment_name
+
+
+def _table_snapshot(db: models.EnvDB) -> tuple[cache.Snapshot, bool]:
+    """Get the EnvDB snapshot and if it had to be loaded.
+    The snapshot is pinned for the rest of the block when a request snapshot is open, outside of
+    snapshot mode the table is loaded with a single search the first time the block needs it.
+    """
+    pinned = _pinned(db)
+    if pinned is not None and pinned.table is not None:
+        return pinned.table, False
+
+    if db.snapshot_enabled:
+        stale = db.snapshot_stale
+        table = db.snapshot
+    else:
+        table, stale = cache.Snapshot(db.search(), db.environments), True
+    if pinned is not None:
+        pinned.table = table
+    return table, stale
+
+
+def _searches(name: str, db: models.EnvDB, environment_name: str | None) -> list[dict]:
+    """The searches for a variable in the order they should be tried"""
+    searches = list()
+    if environment_name:
+        # Try the simple search using the environment name
+        searches.append({"key": name, environment_name: True})
+
+    """ 
+    The default search is used when one of:
+        1. environments are not enabled
+        2. we were unable to resolve the current environment
+        3. there was no entry for the environment specified and we are looking for a default
+    These all have the same solution of looking for the row that matches with the default env.
+    """
+    searches.append({"key": name, **_normalize_environment_request(None, db.environments)})
+    return searches
+
+
+def _assign_value(
+    variable: models.Variable, searches: list[dict], lookup: Callable[[dict], Row | dict | None]
+) -> models.Variable:
+    """Assign the value of the first search that finds a row"""
+    for search in searches:
+        row = lookup(search)
+        if row is not None:
+            # Assign the variable value if one was found
+            variable.value = row["value"]
+            break
+    return variable
+
+
+def _known_missing(variable: models.Variable, db: models.EnvDB, environment_name: str | None) -> bool:
+    """Check the negative cache for a variable that was recently not found in the table"""
+    return db.negative_cache is not None and db.negative_cache.hit(variable.name, environment_name)
+
+
+def _remember_missing(variable: models.Variable, db: models.EnvDB, environment_name: str | None):
+    """Add a variable that was not found in the table to the negative cache"""
+    if db.negative_cache is not None and not variable.in_use:
+        db.negative_cache.add(variable.name, environment_name)
+
+
 def _get_value(
     variable: models.Variable, db: models.EnvDB, environment: models.LazyEnvironment
 ) -> models.Variable:
@@ -177,36 +442,111 @@ def _get_value(
     Returns:
         variable object.
     """
-    search = {"key": variable.name}
+    pinned = _pinned(db)
+    if pinned is not None and pinned.recall(variable):
+        VARIABLES.metrics.cache_result("hit")
+        return variable
+
+    _lookup_value(variable, db, environment)
+    if pinned is not None:
+        pinned.remember(variable)
+    return variable
 
-    row = None
-    if db.environments_enabled and environment is not None:
-        environment_name = resolve_environment(environment.name, db.environments)
-        if environment_name:
-            # Try the simple search using the environment name
-            search[environment_name] = True
-            row = _try_lookup(search, db.table)
-
-    if row is None:
-        """ 
-        we are here because one of:
-            1. environments are not enabled
-            2. we were unable to resolve the current environment
-            3. there was no entry for the environment specified and we are looking for a default
-        These all have the same solution of looking for the row that matches with the default env.
-        """
-        env_request = _normalize_environment_request(None, db.environments)
-        search.update(env_request)
-        row = _try_lookup(search, db.table)
-
-    if row is not None:
-        # Assign the variable value if one was found
-        variable.value = row["value"]
+
+def _lookup_value(
+    variable: models.Variable, db: models.EnvDB, environment: models.LazyEnvironment
+) -> models.Variable:
+    """Look up an environment variable in the negative cache, snapshot or table"""
+    metrics = VARIABLES.metrics
+    environment_name = _environment_name(db, environment)
+    if _known_missing(variable, db, environment_name):
+        # Not in the table last time we looked, use the default without a lookup
+        metrics.cache_result("negative_hit")
+        return variable
+
+    searches = _searches(variable.name, db, environment_name)
+    if db.snapshot_enabled or _pinned(db) is not None:
+        # Answer from the in-memory snapshot, it is only a miss when the snapshot needs loading
+        start = metrics.start()
+        snapshot, stale = _table_snapshot(db)
+        metrics.observe("table", start if stale else None)
+        metrics.cache_result("miss" if stale else "hit")
+        _assign_value(variable, searches, lambda search: _try_lookup(search, snapshot))
+
+    else:
+        # Fetch the candidate rows for every search in one round trip and pick the winner here,
+        # threads looking up the same variable at the same time share the round trip
+        start = metrics.start()
+        rows = db.search(any_of=searches)
+        metrics.observe("table", start)
+        metrics.cache_result("miss")
+        _assign_value(variable, searches, lambda search: _select_row(rows, search))
+
+    _remember_missing(variable, db, environment_name)
 
     # this return is not strictly necessary since we are updating the variable object.
     return variable
 
 
+def _get_values(
+    variables: list[models.Variable], db: models.EnvDB, environment: models.LazyEnvironment
+) -> list[models.Variable]:
+    """Get several environment variables with a single search of the table
+    Args:
+        variables: variable objects to look up
+        db: EnvDb object
+        environment: The environment that the app is running in from anvil.app.environment
+
+    Returns:
+        list of variable objects.
+    """
+    if db.snapshot_enabled or _pinned(db) is not None:
+        # The snapshot is in memory, or loaded once for the request, so there are no round trips to save
+        return [_get_value(variable, db, environment) for variable in variables]
+
+    return _lookup_values(variables, db, environment)
+
+
+def _lookup_values(
+    variables: list[models.Variable], db: models.EnvDB, environment: models.LazyEnvironment
+) -> list[models.Variable]:
+    """Look up environment variables in the negative cache, then the table with a single search"""
+    metrics = VARIABLES.metrics
+    environment_name = _environment_name(db, environment)
+    pending = [variable for variable in variables if not _known_missing(variable, db, environment_name)]
+    metrics.cache_result("negative_hit", len(variables) - len(pending))
+    if not pending:
+        return variables
+
+    start = metrics.start()
+    rows = dict()
+    for row in db.search(keys=[variable.name for variable in pending]):
+        rows.setdefault(row["key"], []).append(row)
+    metrics.observe("table", start)
+    metrics.cache_result("miss", len(pending))
+
+    for variable in pending:
+        candidates = rows.get(variable.name, [])
+        _assign_value(
+            variable,
+            _searches(variable.name, db, environment_name),
+            lambda search: _select_row(candidates, search),
+        )
+        _remember_missing(variable, db, environment_name)
+    return variables
+
+
+def _read_value(variable: models.Variable) -> Any:
+    """Read the value of a variable, timing the fetch when it is a secret"""
+    if not isinstance(variable._value, models.Secret):
+        return variable.value
+
+    start = VARIABLES.metrics.start()
+    value = variable.value
+    VARIABLES.metrics.observe("secret", start)
+    return value
+
+
 def get(name: str, default=models.NotSet) -> Any:
     """Get an environment variable and register its use
     Args:
@@ -220,6 +560,7 @@ def get(name: str, default=models.NotSet) -> Any:
         raises a LookupError if the variable is not available in the env table and no
         default value is given.
     """
+    VARIABLES._read(name)
     variable = models.Variable(name, default)
     if DB.is_ready:
         variable = _get_value(variable, DB, ENVIRONMENT)
@@ -227,7 +568,7 @@ def get(name: str, default=models.NotSet) -> Any:
     else:
         logger.info(f"'env' not setup, returning default value for: {variable}")
 
-    value = variable.value
+    value = _read_value(variable)
     if value == models.NotSet:
         raise LookupError(
             f"env: {variable.name} not found in '{DB.name}' and no default value given."
@@ -235,3 +576,214 @@ def get(name: str, default=models.NotSet) -> Any:
 
     VARIABLES._register(variable)
     return value
+
+
+def get_many(names: Iterable[str], defaults: dict | None = None) -> dict:
+    """Get several environment variables with a single table search and register their use
+    Args:
+        names, names of the variables
+        defaults, dict of default values by variable name. Variables without a default are required.
+
+    Returns:
+        dict of the variable values by name.
+
+    Raises:
+        raises a LookupError listing every required variable that is not available in the
+        env table.
+    """
+    defaults = defaults or dict()
+    variables = [models.Variable(name, defaults.get(name, models.NotSet)) for name in dict.fromkeys(names)]
+    if DB.is_ready:
+        variables = _get_values(variables, DB, ENVIRONMENT)
+
+    else:
+        logger.info(f"'env' not setup, returning default values for: {', '.join(map(str, variables))}")
+
+    values = dict()
+    missing = list()
+    for variable in variables:
+        VARIABLES._read(variable.name)
+        value = _read_value(variable)
+        if value == models.NotSet:
+            missing.append(variable.name)
+        else:
+            values[variable.name] = value
+            VARIABLES._register(variable)
+
+    if missing:
+        raise LookupError(
+            f"env: {', '.join(missing)} not found in '{DB.name}' and no default value given."
+        )
+    return values
+
+
+def resolve_all(environment: str | None = None, secrets: bool = False) -> dict:
+    """Resolve every variable in the env table for an environment with a single search
+    The environment is matched to a table environment column with the same rules as get, falling
+    back to the default row for each variable.  Variables are not registered as in use.
+
+    Args:
+        environment: app environment name ie. 'Published' or 'Debug for abc@example.com',
+                     None for the environment the app is running in
+        secrets: fetch the values of secrets, otherwise they are returned as Secret pointers
+
+    Returns:
+        dict of the variable values by name, sorted by name.
+    """
+    if not DB.is_ready:
+        logger.info("'env' not setup, no variables to resolve")
+        return dict()
+
+    if environment is None:
+        environment_name = _environment_name(DB, ENVIRONMENT)
+    elif DB.environments_enabled:
+        environment_name = DB.resolver.resolve(environment)
+    else:
+        environment_name = None
+
+    if DB.snapshot_enabled or _pinned(DB) is not None:
+        table, _ = _table_snapshot(DB)
+    else:
+        start = VARIABLES.metrics.start()
+        table = cache.Snapshot(DB.search(), DB.environments)
+        VARIABLES.metrics.observe("table", start)
+
+    values = dict()
+    for name in sorted(table.keys - models.RESERVED_KEYS):
+        variable = models.Variable(name, models.NotSet)
+        _assign_value(variable, _searches(name, DB, environment_name), lambda search: _try_lookup(search, table))
+        if variable.in_use:
+            values[name] = _read_value(variable) if secrets else variable._value
+    return values
+
+
+def _prefetch_secret(secret: models.Secret, ttl: float):
+    """Fetch a secret into the secret cache ahead of its next read"""
+    start = VARIABLES.metrics.start()
+    secret._warm(ttl)
+    VARIABLES.metrics.observe("secret", start)
+
+
+def prefetch(
+    names: Iterable[str],
+    secrets: bool = True,
+    max_workers: int = 6,
+    timeout: float | None = 10.0,
+    ttl: float = 300.0,
+) -> dict:
+    """Warm up variables ahead of their first get
+    The variables are looked up with a single search and registered.  With secrets, the secrets
+    they point to are fetched concurrently into the secret cache.  A secret that fails or times
+    out is reported without stopping the others.
+
+    Args:
+        names: names of the variables
+        secrets: fetch the secrets the variables point to
+        max_workers: most secrets to fetch at once
+        timeout: seconds to wait for each secret from when its fetch starts, None to wait until
+                 they are fetched.  A fetch that times out can't be cancelled, it finishes in the
+                 background and still fills the cache.
+        ttl: seconds to keep a secret that doesn't have caching enabled with Secret.enable_cache,
+             it is only used for the first read.  Cached secrets keep their own ttl.
+
+    Returns:
+        dict of the exception for each variable whose secret could not be fetched, empty when
+        every fetch succeeded.
+    """
+    variables = [models.Variable(name, models.NotSet) for name in dict.fromkeys(names)]
+    if not DB.is_ready:
+        logger.info(f"'env' not setup, nothing to prefetch for: {', '.join(map(str, variables))}")
+        return dict()
+
+    for variable in _get_values(variables, DB, ENVIRONMENT):
+        if variable.in_use:
+            VARIABLES._register(variable)
+
+    pending = {variable.name: variable._value for variable in variables if isinstance(variable._value, models.Secret)}
+    if not secrets or not pending:
+        return dict()
+
+    started = dict()
+
+    def fetch(name: str, secret: models.Secret):
+        started[name] = time.monotonic()
+        _prefetch_secret(secret, ttl)
+
+    workers = min(max_workers, len(pending))
+    executor = ThreadPoolExecutor(workers, thread_name_prefix="environ-prefetch")
+    futures = {
+        executor.submit(contextvars.copy_context().run, fetch, name, secret): name
+        for name, secret in pending.items()
+    }
+    # Fetches stuck past their timeout still hold a worker, give up on the queue once every
+    # fetch could have had its turn
+    deadline = None if timeout is None else time.monotonic() + timeout * math.ceil(len(futures) / workers)
+
+    failures = dict()
+    remaining = futures.keys()
+    while remaining:
+        wait_for = None
+        if timeout is not None:
+            starts = [started[futures[future]] for future in remaining if futures[future] in started]
+            wait_for = max(0.0, min([start + timeout for start in starts] + [deadline]) - time.monotonic())
+        done, remaining = wait(remaining, timeout=wait_for, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                failures[futures[future]] = future.exception()
+
+        if timeout is not None:
+            now = time.monotonic()
+            expired = {
+                future for future in remaining
+                if now >= deadline or now - started.get(futures[future], now) >= timeout
+            }
+            for future in expired:
+                failures[futures[future]] = TimeoutError(f"Fetching the secret took longer than {timeout}s")
+            remaining = remaining - expired
+    # Don't wait on slow fetches, they finish in the background
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for name, error in failures.items():
+        logger.warning(f"env: unable to prefetch the secret for {name}: {error!r}")
+    return failures
+
+
+def enable_usage_profile(
+    path: str | None = None, prefetch_names: bool = True, limit: int | None = None, secrets: bool = False
+) -> dict:
+    """Learn which variables the process reads and prefetch them when it next starts
+    Call this where the app starts, ie. at import.  The profile from earlier runs is prefetched in a
+    single search and the reads from this run are added to it at exit.
+
+    Args:
+        path: JSON file to keep the profile in, None to keep it in a reserved row of the env table
+        prefetch_names: prefetch the variables in the stored profile now
+        limit: prefetch at most this many of the most read variables, None for all of them
+        secrets: also fetch the secrets the variables point to, see prefetch
+
+    Returns:
+        the secret failures from prefetch, empty when there were none
+    """
+    profile = models.UsageProfile(DB, path)
+    if VARIABLES.usage is None:
+        atexit.register(_save_usage_profile)
+    VARIABLES.usage = profile
+
+    if not prefetch_names:
+        return dict()
+    names = profile.names(limit)
+    return prefetch(names, secrets=secrets) if names else dict()
+
+
+def save_usage_profile():
+    """Add the reads so far to the stored usage profile, this is done at exit as well"""
+    if VARIABLES.usage is not None:
+        VARIABLES.usage.save()
+
+
+def _save_usage_profile():
+    """Save the usage profile at exit, the connection may already be gone"""
+    try:
+        save_usage_profile()
+    except Exception as e:
+        logger.warning(f"env: unable to save the usage profile: {e!r}")